@@ -1,38 +1,86 @@
-import argparse
 import asyncio
+import time
+from typing import List
 from colorama import Fore, Style
 
-from audiobookshelf.client import ABSClient
-from abs_util.util import display_error, add_default_args
+from abs_util.api import ABSApi
+from abs_util.stats import STATS
+from abs_util.util import display_error
+
+
+async def get_orphan_authors(client: ABSApi, lib: dict) -> List[dict]:
+    print(f'{Fore.LIGHTCYAN_EX}Checking authors for library {Fore.GREEN}{lib["name"]}{Fore.LIGHTCYAN_EX}...{Style.RESET_ALL}')
+    # collect first, deleting while paging would shift the following pages
+    return [a async for a in client.iter_library_authors(lib['id'], fields=('id', 'name', 'numBooks')) if a['numBooks'] == 0]
+
+
+async def delete_authors(args, client: ABSApi, authors: List[dict]) -> int:
+    """Delete the given authors with at most args.jobs requests in flight, retrying failed deletes. Returns the number of deleted authors"""
+    queue = asyncio.Queue()
+    deleted = 0
+
+    async def _worker():
+        nonlocal deleted
+        while True:
+            author = await queue.get()
+            try:
+                for attempt in range(args.retries + 1):
+                    try:
+                        await client.delete_author(author['id'])
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        if attempt >= args.retries:
+                            display_error(f'Failed to remove author {author["name"]}: {e}')
+                        else:
+                            await asyncio.sleep(2 ** attempt)
+                        continue
+                    deleted += 1
+                    print(f'{Fore.LIGHTCYAN_EX}- removed author {Fore.GREEN}{author["name"]}{Fore.LIGHTCYAN_EX}: has no books{Style.RESET_ALL}')
+                    break
+            finally:
+                queue.task_done()
+
+    for author in authors:
+        queue.put_nowait(author)
+    workers = [asyncio.create_task(_worker()) for _ in range(args.jobs)]
+    try:
+        await queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return deleted
 
 
 async def clear_authors(args):
-    client = ABSClient(args.server)
-    await client.authorize(args.user, args.password)
-    libs = await client.get_libraries()
-    lib_filter = args.library
-    found_filter = lib_filter is None
-    for lib in libs:
-        if lib_filter is not None and not lib['name'].lower() == lib_filter.lower():
-            continue
-        found_filter = True
-        print(f'{Fore.LIGHTCYAN_EX}Checking authors for library {Fore.GREEN}{lib["name"]}{Fore.LIGHTCYAN_EX}...{Style.RESET_ALL}')
-        authors = await client.get_library_authors(lib['id'])
-        for author in authors:
-            if author['numBooks'] == 0:
-                print(f'{Fore.LIGHTCYAN_EX}- removed author {Fore.GREEN}{author["name"]}{Fore.LIGHTCYAN_EX}: has no books{Style.RESET_ALL}')
-                await client.delete_author(author['id'])
-    if not found_filter:
-        display_error(f'"{lib_filter}" is not a valid library!')
+    start = time.perf_counter()
+    async with ABSApi(args.server) as client:
+        with STATS.phase('login'):
+            await client.authorize(args.user, args.password)
+        libs = await client.get_libraries()
+        lib_filter = args.library
+        if lib_filter is not None:
+            libs = [lib for lib in libs if lib['name'].lower() == lib_filter.lower()]
+            if len(libs) == 0:
+                display_error(f'"{lib_filter}" is not a valid library!')
+                return
+        with STATS.phase('author scan'):
+            orphans = [a for authors in await asyncio.gather(*[get_orphan_authors(client, lib) for lib in libs]) for a in authors]
+        scanned = time.perf_counter()
+        if args.dry_run:
+            for author in orphans:
+                print(f'{Fore.LIGHTCYAN_EX}- would remove author {Fore.GREEN}{author["name"]}{Fore.LIGHTCYAN_EX}: has no books{Style.RESET_ALL}')
+            print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(orphans)}{Fore.LIGHTCYAN_EX} authors without books in '
+                  f'{Fore.GREEN}{len(libs)}{Fore.LIGHTCYAN_EX} libraries in {Fore.GREEN}{scanned - start:.2f}s{Fore.LIGHTCYAN_EX}, '
+                  f'nothing was removed (dry run){Style.RESET_ALL}')
+            return
+        with STATS.phase('author removal'):
+            deleted = await delete_authors(args, client, orphans)
+    print(f'{Fore.LIGHTCYAN_EX}Removed {Fore.GREEN}{deleted}{Fore.LIGHTCYAN_EX}/{Fore.GREEN}{len(orphans)}{Fore.LIGHTCYAN_EX} authors without books '
+          f'from {Fore.GREEN}{len(libs)}{Fore.LIGHTCYAN_EX} libraries (scan {Fore.GREEN}{scanned - start:.2f}s{Fore.LIGHTCYAN_EX}, '
+          f'removal {Fore.GREEN}{time.perf_counter() - scanned:.2f}s{Fore.LIGHTCYAN_EX}){Style.RESET_ALL}')
 
 
 def clear_authors_action(args, cfg):
     asyncio.run(clear_authors(args))
-
-
-def clear_authors_parser(sub_parser, cfg: dict):
-    parser = sub_parser.add_parser('clear-authors', help='Remove authors with no books from either all or selected libraries',
-                                   formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100, width=360))
-    parser.set_defaults(func=clear_authors_action)
-    add_default_args(parser, cfg, 'base-api')
-    add_default_args(parser, cfg, 'library')
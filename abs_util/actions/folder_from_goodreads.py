@@ -1,5 +1,6 @@
-import argparse
 import asyncio
+import csv
+import importlib.util
 import os.path
 from email.policy import default
 
@@ -7,57 +8,154 @@ from colorama import Fore, Style
 
 from aiohttp import ClientSession
 from bs4 import BeautifulSoup
-from abs_util.util import request_prompt, open_path
+from abs_util.api import ABSApi, get_target_libs
+from abs_util.fs import AsyncFS
+from abs_util.http_cache import HTTPCache
+from abs_util.library_cache import LibraryCache
+from abs_util.library_index import LibraryIndex
+from abs_util.stats import STATS
+from abs_util.util import request_prompt, open_path, display_error, get_http_cache_dir, get_library_cache_path
 import re
+from typing import List, Optional, Tuple
 
 
 RE_BOOK_NUMBER = re.compile(r'^Book (\d+\.?\d*)$')
 
 RE_FORBIDDEN_CHARS = re.compile(r'[<>:"/\\|?*]')
 
+# titles in a Goodreads export end with "(Series Name, #1)" if the book is part of a series
+RE_SERIES_TITLE = re.compile(r'\(.+, #[\d.]+\)$')
 
-async def action(args, cfg):
-    series_url = args.goodreads_series
-    async with ClientSession() as session:
-        req = await session.get(series_url)
-        html = await req.text()
-        soup = BeautifulSoup(html, 'html.parser')
+RE_SERIES_LINK = re.compile(r'(?:https://www\.goodreads\.com)?/series/(\d+)')
+
+GOODREADS_URL = 'https://www.goodreads.com'
+
+# fields of library items needed to recognize books that are already in the library, the listing only has authorName and seriesName
+# on current servers and only the authors and series lists on older ones
+INDEX_FIELDS = ('id', 'relPath', 'updatedAt', 'media.metadata.title', 'media.metadata.authorName', 'media.metadata.authors',
+                'media.metadata.seriesName', 'media.metadata.series')
+
+# lxml is a lot faster than the builtin parser but optional
+HTML_PARSER = 'lxml' if importlib.util.find_spec('lxml') is not None else 'html.parser'
+
+
+def parse_series(html: str) -> Tuple[str, List[Tuple[str, str, str]]]:
+    """Returns the series title and author, number and title of every numbered book of a series page"""
+    soup = BeautifulSoup(html, HTML_PARSER)
     series_title = soup.find('div', class_='responsiveSeriesHeader__title').text
     if series_title.endswith(' Series'):
         series_title = series_title.replace(' Series', '')
-    print(f'{Fore.LIGHTCYAN_EX}Found series {Fore.GREEN}{series_title}')
-    author = None
+    books = []
     for tag in soup.find_all('div', class_='listWithDividers__item'):
         book = tag.find('h3').text
         book_nr = RE_BOOK_NUMBER.findall(book)
         if len(book_nr) == 0:
             continue
-        book_nr = book_nr[0]
-        title = RE_FORBIDDEN_CHARS.sub('', tag.find('span').text)
-        author = RE_FORBIDDEN_CHARS.sub('', tag.find('span', {'itemprop': 'author'}).text)
-        folder_name = f'{book_nr:0>2} - {title}'
-        root = args.library_dir
-        path = os.path.join(root, author, series_title, folder_name)
-        if not os.path.exists(path):
+        books.append((tag.find('span', {'itemprop': 'author'}).text, book_nr[0], tag.find('span').text))
+    return series_title, books
+
+
+def read_series_file(path: str) -> List[str]:
+    """Series URLs of a text file, one per line, empty lines and lines starting with # are ignored"""
+    with open(path, encoding='utf-8') as _f:
+        return [line.strip() for line in _f if len(line.strip()) > 0 and not line.strip().startswith('#')]
+
+
+def read_goodreads_csv(path: str) -> List[str]:
+    """Book ids of all books of a Goodreads library export that are part of a series"""
+    with open(path, encoding='utf-8', newline='') as _f:
+        return [row['Book Id'] for row in csv.DictReader(_f) if RE_SERIES_TITLE.search(row['Title']) is not None]
+
+
+async def find_book_series(fetcher: HTTPCache, book_id: str) -> Optional[str]:
+    """URL of the series a book belongs to, taken from its Goodreads book page"""
+    match = RE_SERIES_LINK.search(await fetcher.get(f'{GOODREADS_URL}/book/show/{book_id}'))
+    return f'{GOODREADS_URL}/series/{match.group(1)}' if match is not None else None
+
+
+async def load_library_index(args) -> LibraryIndex:
+    """Index the books of the target library, the listing is cached locally and only the changes since the last run are fetched"""
+    async with ABSApi(args.server) as client:
+        with STATS.phase('login'):
+            await client.authorize(args.user, args.password)
+        target_lib = (await get_target_libs(client, [args.library]))[0]
+        library = LibraryCache(client, target_lib, fields=INDEX_FIELDS)
+        cache_path = get_library_cache_path(target_lib['id'])
+        print(f'{Fore.LIGHTCYAN_EX}Loading library {Fore.GREEN}{target_lib["name"]}{Fore.LIGHTCYAN_EX}...')
+        with STATS.phase('library listing'):
+            await asyncio.to_thread(library.load, cache_path)
+            if await library.refresh() > 0:
+                await asyncio.to_thread(library.save, cache_path)
+    index = LibraryIndex(library.items.values())
+    print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{index.size}{Fore.LIGHTCYAN_EX} items in audiobookshelf')
+    return index
+
+
+async def import_series(args, fetcher: HTTPCache, fs: AsyncFS, series_url: str,
+                        index: Optional[LibraryIndex] = None) -> Optional[Tuple[str, str, int]]:
+    """Create the folders of all books of a series that are not in the library yet.
+
+    Returns the author, the series title and the number of books that are already in the library"""
+    try:
+        # parsing a large page takes long enough to hold up the other downloads
+        series_title, books = await asyncio.to_thread(parse_series, await fetcher.get(series_url))
+    except Exception as e:
+        display_error(f'Could not import series {series_url}: {e}')
+        return None
+    print(f'{Fore.LIGHTCYAN_EX}Found series {Fore.GREEN}{series_title}')
+    skipped = []
+
+    async def _create(author: str, book_nr: str, title: str):
+        path = os.path.join(args.library_dir, RE_FORBIDDEN_CHARS.sub('', author), series_title,
+                            f'{book_nr:0>2} - {RE_FORBIDDEN_CHARS.sub('', title)}')
+        existing = index.find(author, series_title, book_nr, title) if index is not None else None
+        if existing is not None:
+            print(f'{Fore.LIGHTCYAN_EX}- skipping {Fore.GREEN}{path}{Fore.LIGHTCYAN_EX}: already in library as {Fore.GREEN}{existing}')
+            skipped.append(path)
+        elif not await fs.isdir(path):
             print(f'{Fore.LIGHTCYAN_EX}- creating folder {Fore.GREEN}{path}{Fore.LIGHTCYAN_EX}...')
-            os.makedirs(path)
+            await fs.makedirs(path)
         else:
             print(f'{Fore.LIGHTCYAN_EX}- skipping {Fore.GREEN}{path}{Fore.LIGHTCYAN_EX}: already exists')
-    if args.open_folder:
-        open_path(os.path.join(args.library_dir, author, series_title))
+    await asyncio.gather(*[_create(*book) for book in books])
+    return (RE_FORBIDDEN_CHARS.sub('', books[-1][0]) if len(books) > 0 else None), series_title, len(skipped)
+
+
+async def action(args, cfg):
+    series_urls = []
+    if args.goodreads_series is not None:
+        series_urls.append(args.goodreads_series)
+    if args.series_file is not None:
+        series_urls += read_series_file(args.series_file)
+    index = await load_library_index(args) if args.library is not None else None
+    async with ClientSession() as session:
+        fetcher = HTTPCache(session, None if args.no_http_cache else get_http_cache_dir(), args.rate, args.jobs)
+        if args.goodreads_csv is not None:
+            book_ids = read_goodreads_csv(args.goodreads_csv)
+            print(f'{Fore.LIGHTCYAN_EX}Looking up the series of {Fore.GREEN}{len(book_ids)}{Fore.LIGHTCYAN_EX} books...')
+            with STATS.phase('book lookup'):
+                found = await asyncio.gather(*[find_book_series(fetcher, book_id) for book_id in book_ids], return_exceptions=True)
+            for book_id, url in zip(book_ids, found):
+                if isinstance(url, BaseException):
+                    display_error(f'Could not look up the series of book {book_id}: {url}')
+                elif url is None:
+                    display_error(f'Could not find a series link on the Goodreads page of book {book_id}')
+                else:
+                    series_urls.append(url)
+        # the same series can be listed more than once
+        series_urls = list(dict.fromkeys(series_urls))
+        with STATS.phase('series import'):
+            with AsyncFS() as fs:
+                imported = await asyncio.gather(*[import_series(args, fetcher, fs, url, index) for url in series_urls])
+    imported = [i for i in imported if i is not None]
+    print(f'{Fore.LIGHTCYAN_EX}Imported {Fore.GREEN}{len(imported)}{Fore.LIGHTCYAN_EX} series, {Fore.GREEN}{sum(i[2] for i in imported)}'
+          f'{Fore.LIGHTCYAN_EX} books are already in the library, {Fore.GREEN}{fetcher.hits}{Fore.LIGHTCYAN_EX} unchanged pages were '
+          f'taken from the cache{Style.RESET_ALL}')
+    if args.open_folder and len(imported) == 1 and imported[0][0] is not None:
+        open_path(os.path.join(args.library_dir, imported[0][0], imported[0][1]))
 
 
 def from_goodreads_action(args, cfg):
-    if args.goodreads_series is None:
+    if args.goodreads_series is None and args.series_file is None and args.goodreads_csv is None:
         args.goodreads_series = request_prompt('Goodreads Series URL')
     asyncio.run(action(args, cfg))
-
-
-def from_goodreads_parser(sub_parser, cfg: dict):
-    parser = sub_parser.add_parser('goodreads-folder-import', help='Create Folders from Goodreads Series Link',
-                                   formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100, width=360))
-    parser.set_defaults(func=from_goodreads_action)
-    parser.add_argument('-libdir', '--library-dir', required=True, default=cfg.get('libdir'), help='The Library base directory')
-    parser.add_argument('--goodreads-series', required=False, help='The URL to a Goodreads series')
-    parser.add_argument('--open-folder', required=False, action='store_true', default=False, help='Open the series folder after creating structure')
-    pass
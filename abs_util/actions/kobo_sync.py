@@ -2,181 +2,636 @@ import argparse
 import asyncio
 import sys
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from collections import namedtuple
-from typing import List
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from typing import List, Dict, Optional, Tuple
 
-from audiobookshelf import ABSClient
 from colorama import Fore, Style
-from abs_util.util import display_error, add_default_args
+from abs_util.util import display_error, get_ebook_cache_dir
+from abs_util.api import ABSApi, get_target_libs
+from abs_util.fs import AsyncFS
+from abs_util.library_cache import LibraryCache
+from abs_util.download_cache import DownloadCache
+from abs_util.covers import get_image_id, get_image_dir, render_thumbnails, write_thumbnails, has_image_support
+from abs_util.stats import STATS
+from abs_util.manifest import ITEM_FILE_NAME, new_manifest, make_entry, load_manifest, save_manifest, rescan_manifest, verify_entry, \
+    file_sha256
 from pprint import pprint
-import json
-import shutil
 import aiosqlite
 
 
+# fields of the library listing needed to find changed items, current servers only send minified items without ebook file there
+LISTING_FIELDS = ('id', 'addedAt', 'updatedAt')
+# fields of the expanded library items used during the sync
+ITEM_FIELDS = ('id', 'relPath', 'addedAt', 'updatedAt', 'media.libraryItemId', 'media.ebookFile', 'media.metadata.title',
+               'media.metadata.subtitle', 'media.metadata.authorName', 'media.metadata.description', 'media.metadata.series',
+               'media.coverPath')
+
 BookRecord = namedtuple('Book', ['title', 'subtitle', 'author', 'description', 'series', 'series_number',
-                                 'series_number_float', 'series_id', 'read_status'])
+                                 'series_number_float', 'series_id', 'read_status', 'percent_read', 'date_last_read'])
 
 
-async def get_target_lib(args, client: ABSClient) -> dict:
+async def get_target_lib(args, client: ABSApi) -> dict:
     """Find valid target library and return"""
-    libs = await client.get_libraries()
-    for lib in libs:
-        if lib['name'].lower() == args.library.lower():
-            if lib['mediaType'] != 'book':
-                display_error(f'Library {lib["name"]} is not of type book.')
-                sys.exit(1)
-            return lib
-    display_error(f'Library {args.library} not found.')
-    sys.exit(1)
-
-
-def build_kobo_tree(args, target_lib) -> List[dict]:
+    return (await get_target_libs(client, [args.library]))[0]
+
+
+class SyncError(Exception):
+    """A kobo reader can not be synced, raised instead of exiting so other readers synced at the same time can finish"""
+    pass
+
+
+def check_kobo_dir(kobo_dir: str):
+    if not os.path.isdir(kobo_dir):
+        raise SyncError(f'Kobo mount directory "{kobo_dir}" does not exists')
+    if not os.path.isfile(os.path.join(kobo_dir, '.kobo', 'KoboReader.sqlite')):
+        raise SyncError(f'No kobo reader database found in "{kobo_dir}", expected .kobo/KoboReader.sqlite')
+
+
+def device_args(args, kobo_dir: str) -> argparse.Namespace:
+    """Copy of args targeting a single kobo reader"""
+    return argparse.Namespace(**{**vars(args), 'kobo_dir': kobo_dir})
+
+
+def get_library_dir(args, target_lib) -> str:
+    return str(os.path.join(args.kobo_dir, 'abs-library', target_lib['id']))
+
+
+async def build_kobo_tree(args, fs: AsyncFS, target_lib) -> dict:
+    """Load the sync manifest of the target library from the kobo reader, rebuilding it if requested or missing"""
     print(f'{Fore.LIGHTCYAN_EX}Building kobo reader tree...{Style.RESET_ALL}')
-    _found = []
-    if not os.path.isdir(args.kobo_dir):
-        display_error(f'Kobo mount directory "{args.kobo_dir}" does not exists')
-        sys.exit(1)
-    lib_dir = str(os.path.join(args.kobo_dir, 'abs-library', target_lib['id']))
-    if not os.path.isdir(lib_dir):
+    lib_dir = get_library_dir(args, target_lib)
+    if not await fs.isdir(lib_dir):
         # library does not exists yet
-        return []
-    for root, dirs, files in os.walk(lib_dir):
-        for filename in files:
-            if filename.lower().endswith('abs-item.json'):
-                with open(os.path.join(root, filename), 'r') as _f:
-                    item_data = json.load(_f)
-                item_dir = os.path.dirname(os.path.join(root, filename))
-                _found.append({'id': item_data['id'], 'folder': item_dir})
-    return _found
-    pass
+        return new_manifest()
+    manifest = None if args.rescan else await fs.run(load_manifest, lib_dir)
+    if manifest is None:
+        print(f'{Fore.LIGHTCYAN_EX}Rebuilding sync manifest from kobo reader files...{Style.RESET_ALL}')
+        manifest = await fs.run(rescan_manifest, lib_dir)
+    if args.verify or args.verify_hash:
+        print(f'{Fore.LIGHTCYAN_EX}Verifying ebook files on kobo reader...{Style.RESET_ALL}')
+        entries = list(manifest['items'].values())
+        valid = await asyncio.gather(*[fs.run(verify_entry, lib_dir, e, args.verify_hash) for e in entries])
+        corrupt = [e['id'] for e, is_valid in zip(entries, valid) if not is_valid]
+        for item_id in corrupt:
+            print(f'{Fore.LIGHTCYAN_EX}- Ebook file of item {Fore.GREEN}{item_id}{Fore.LIGHTCYAN_EX} is incomplete or corrupt, '
+                  f'it will be downloaded again')
+            # treated as missing from here on, the download replaces the file
+            del manifest['items'][item_id]
+    return manifest
 
 
-async def sync_item(args, client: ABSClient, target_lib, item: dict):
-    title = item['media']['metadata']['title']
-    author = item['media']['metadata']['authorName']
-    print(f'{Fore.LIGHTCYAN_EX}- Syncing missing item {Fore.GREEN}{item['id']}{Fore.LIGHTCYAN_EX} - '
-          f'{Fore.LIGHTGREEN_EX}{title}{Fore.LIGHTCYAN_EX} by {Fore.LIGHTGREEN_EX}{author}{Fore.LIGHTCYAN_EX} to kobo reader')
-    item_dir = str(os.path.join(args.kobo_dir, 'abs-library', target_lib['id'], item['relPath']))
-    if not os.path.exists(item_dir):
-        os.makedirs(item_dir)
-    item_data = await client.get_library_item(item['id'])
-    # write item data
-    with open(os.path.join(item_dir, 'abs-item.json'), 'w') as _f:
-        json.dump({
-            'id': item['id'],
-        }, _f)
-    efile = item_data['media']['ebookFile']
+async def sync_item(args, client: ABSApi, fs: AsyncFS, target_lib, item: dict, downloads: Optional[DownloadCache] = None) -> dict:
+    """Download a single expanded item to the kobo reader and return its manifest entry"""
+    item_dir = str(os.path.join(get_library_dir(args, target_lib), item['relPath']))
+    await fs.makedirs(item_dir)
+    efile = item['media']['ebookFile']
     target_file_path = os.path.join(item_dir, efile['metadata']['relPath'])
-    await client.download_file(item_data['media']['libraryItemId'], efile['ino'], str(target_file_path))
+    if downloads is not None:
+        async with downloads.use_file(item['media']['libraryItemId'], efile['ino'], efile['metadata']['size']) as source:
+            await fs.copy_file(source, str(target_file_path))
+    else:
+        await client.download_file(item['media']['libraryItemId'], efile['ino'], str(target_file_path), efile['metadata']['size'], fs=fs)
+    entry = make_entry(item['id'], item['relPath'], efile['metadata']['relPath'], efile['ino'], efile['metadata']['size'],
+                       await fs.getmtime(target_file_path), item.get('updatedAt'),
+                       await fs.run(file_sha256, target_file_path) if args.verify_hash else None)
+    # write item data only after the download went through so failed items get picked up again on the next run
+    await fs.write_json(os.path.join(item_dir, ITEM_FILE_NAME), entry)
+    return entry
 
 
-async def remove_item(item: dict):
-    print(f'{Fore.LIGHTCYAN_EX}- Removing unexpected item {Fore.GREEN}{item['id']}{Fore.LIGHTCYAN_EX} from {Fore.GREEN}{item['folder']}')
-    shutil.rmtree(item['folder'])
+def print_download_progress(progress: dict, total: int, end: str = ''):
+    print(f'\r{Fore.LIGHTCYAN_EX}- Downloaded {Fore.GREEN}{progress["done"]}{Fore.LIGHTCYAN_EX}/{Fore.GREEN}{total}{Fore.LIGHTCYAN_EX} items, '
+          f'{Fore.GREEN}{progress["retried"]}{Fore.LIGHTCYAN_EX} retries, {Fore.GREEN}{len(progress["failed"])}{Fore.LIGHTCYAN_EX} failed'
+          f'{Style.RESET_ALL}', end=end, flush=True)
 
 
-async def sync_metadata(args, client: ABSClient, db, target_lib, item, kobo_item):
-    item_data = await client.get_library_item(item['id'], include=['progress', 'authors'], expanded=True)
-    efile = item_data['media']['ebookFile']
-    item_id = f'file:///mnt/onboard/abs-library/{target_lib['id']}/{item['relPath']}/{efile['metadata']['relPath']}'
-    current_status: BookRecord = None
-    async with db.execute('SELECT Title, Subtitle, Attribution, Description, Series, SeriesNumber, SeriesNumberFloat, SeriesID, ReadStatus '
-                          'FROM content WHERE ContentID == ? AND ContentType == 6', (item_id,)) as cursor:
+async def sync_missing_items(args, client: ABSApi, fs: AsyncFS, target_lib, missing_items: List[dict],
+                             downloads: Optional[DownloadCache] = None) -> Dict[str, dict]:
+    """Download all missing items with at most args.jobs transfers in flight.
+
+    The items already carry their expanded data, items that fail are retried up to args.retries times.
+    Returns the manifest entries of all successfully synced items."""
+    download_queue = asyncio.Queue()
+    progress = {'done': 0, 'retried': 0, 'failed': []}
+    synced = {}
+    total = len(missing_items)
+
+    async def _with_retry(item: dict, coro_func, *coro_args) -> tuple:
+        """returns (success, result) of the first attempt that did not raise"""
+        for attempt in range(args.retries + 1):
+            try:
+                return True, await coro_func(*coro_args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt >= args.retries:
+                    progress['failed'].append((item, e))
+                    return False, None
+                progress['retried'] += 1
+                await asyncio.sleep(2 ** attempt)
+
+    async def _download_worker():
+        while True:
+            item = await download_queue.get()
+            try:
+                success, entry = await _with_retry(item, sync_item, args, client, fs, target_lib, item, downloads)
+                if success:
+                    synced[item['id']] = entry
+                    progress['done'] += 1
+                print_download_progress(progress, total)
+            finally:
+                download_queue.task_done()
+
+    for missing_item in missing_items:
+        download_queue.put_nowait(missing_item)
+    workers = [asyncio.create_task(_download_worker()) for _ in range(args.jobs)]
+    try:
+        await download_queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    print_download_progress(progress, total, end='\n')
+    for item, error in progress['failed']:
+        display_error(f'Failed to sync item {item["id"]} ({item["media"]["metadata"]["title"]}): {error}')
+    return synced
+
+
+async def remove_item(fs: AsyncFS, lib_dir: str, item: dict) -> bool:
+    """Remove the folder of an item from the reader, returns False if it could not be removed"""
+    folder = os.path.join(lib_dir, item['folder'])
+    print(f'{Fore.LIGHTCYAN_EX}- Removing unexpected item {Fore.GREEN}{item['id']}{Fore.LIGHTCYAN_EX} from {Fore.GREEN}{folder}')
+    try:
+        await fs.rmtree(folder)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        display_error(f'Could not remove item {item["id"]} from {folder}: {e}')
+        return False
+    return True
+
+
+METADATA_QUERY = ('UPDATE content SET Title = ?, Subtitle = ?, Attribution = ?, Description = ?, Series = ?, SeriesNumber = ?, '
+                  'SeriesNumberFloat = ?, SeriesID = ? WHERE ContentID = ?')
+PROGRESS_QUERY = 'UPDATE content SET ReadStatus = ?, ___PercentRead = ? WHERE ContentID = ?'
+# progress differences below this are considered the same
+PROGRESS_TOLERANCE = 0.01
+
+
+def get_content_id(target_lib, folder: str, file: str) -> str:
+    return f'file:///mnt/onboard/abs-library/{target_lib['id']}/{folder}/{file}'
+
+
+def parse_kobo_date(value: Optional[str]) -> Optional[int]:
+    """Parse a kobo database timestamp into ms since epoch"""
+    if value is None or len(value) == 0:
+        return None
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+async def load_kobo_content(db, target_lib) -> Dict[str, BookRecord]:
+    """Read all books of the target library from the kobo database in one query, keyed by ContentID"""
+    content = {}
+    async with db.execute('SELECT ContentID, Title, Subtitle, Attribution, Description, Series, SeriesNumber, SeriesNumberFloat, SeriesID, '
+                          'ReadStatus, ___PercentRead, DateLastRead FROM content WHERE ContentType == 6 AND ContentID LIKE ?',
+                          (f'file:///mnt/onboard/abs-library/{target_lib['id']}/%',)) as cursor:
         async for row in cursor:
-            current_status = BookRecord._make(row)
-    if current_status is not None:
-        is_same = True
-        metadata = item_data['media']['metadata']
-        is_same &= current_status.title == metadata['title']
-        is_same &= current_status.subtitle == metadata['subtitle']
-        is_same &= current_status.author == metadata['authorName']
-        is_same &= current_status.description == metadata['description']
-        if len(metadata['series']) > 0:
-            is_same &= current_status.series == metadata['series'][0]['name']
-            is_same &= current_status.series_number == metadata['series'][0]['sequence']
-            is_same &= current_status.series_id == metadata['series'][0]['id']
-            is_same &= current_status.series_number_float == float(metadata['series'][0]['sequence'])
-        update_status = False
-        if not args.no_progress_sync:
-            if item_data.get('userMediaProgress') is not None and item_data['userMediaProgress']['isFinished'] and current_status.read_status != 2:
-                is_same = False
-                update_status = True
-        # temp
-        if not is_same:
-            print(f'{Fore.LIGHTCYAN_EX}- Syncing metadata and reading progress for item {Fore.GREEN}{item['id']}')
-        if not is_same:
-            payload = (
-                metadata['title'],
-                metadata['subtitle'],
-                metadata['authorName'],
-                metadata['description'],
-            )
-            if len(metadata['series']) > 0:
-                payload += (metadata['series'][0]['name'],
-                            metadata['series'][0]['sequence'],
-                            float(metadata['series'][0]['sequence']),
-                            metadata['series'][0]['id'])
-            else:
-                payload += (None, None, None, None)
-            if update_status:
-                payload += (2 if item_data['userMediaProgress']['isFinished'] else current_status.read_status,)
-            status_query = ('UPDATE content SET Title = ?, Subtitle = ?, Attribution = ?, Description = ?, Series = ?, SeriesNumber = ?, '
-                            'SeriesNumberFloat = ?, SeriesID = ?, ReadStatus = ? WHERE ContentID = ?')
-            metadata_query = ('UPDATE content SET Title = ?, Subtitle = ?, Attribution = ?, Description = ?, Series = ?, SeriesNumber = ?, '
-                              'SeriesNumberFloat = ?, SeriesID = ? WHERE ContentID = ?')
-            await db.execute(status_query if update_status else metadata_query, payload + (item_id,))
-            await db.commit()
+            content[row[0]] = BookRecord._make(row[1:])
+    return content
 
 
-async def kobo_sync(args):
-    client = ABSClient(args.server)
-    await client.authorize(args.user, args.password)
-    db = await aiosqlite.connect(str(os.path.join(args.kobo_dir, '.kobo', 'KoboReader.sqlite')))
-    target_lib = await get_target_lib(args, client)
-    print(f'{Fore.LIGHTCYAN_EX}Collect all items from library {Fore.GREEN}{target_lib["name"]}{Fore.LIGHTCYAN_EX}...')
-    lib_items = await client.get_library_items(target_lib['id'], limit=0)
-    print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{lib_items["total"]}{Fore.LIGHTCYAN_EX} items in audiobookshelf')
-    lib_items = {d['id']: d for d in lib_items['results']}
-    kobo_items = build_kobo_tree(args, target_lib)
+def diff_metadata(item_data: dict, current_status: BookRecord) -> Optional[tuple]:
+    """Compare the kobo record with the ABS item, returns None if nothing changed or the update payload (without ContentID)"""
+    is_same = True
+    metadata = item_data['media']['metadata']
+    is_same &= current_status.title == metadata['title']
+    is_same &= current_status.subtitle == metadata['subtitle']
+    is_same &= current_status.author == metadata['authorName']
+    is_same &= current_status.description == metadata['description']
+    if len(metadata['series']) > 0:
+        is_same &= current_status.series == metadata['series'][0]['name']
+        is_same &= current_status.series_number == metadata['series'][0]['sequence']
+        is_same &= current_status.series_id == metadata['series'][0]['id']
+        is_same &= current_status.series_number_float == float(metadata['series'][0]['sequence'])
+    if is_same:
+        return None
+    payload = (
+        metadata['title'],
+        metadata['subtitle'],
+        metadata['authorName'],
+        metadata['description'],
+    )
+    if len(metadata['series']) > 0:
+        payload += (metadata['series'][0]['name'],
+                    metadata['series'][0]['sequence'],
+                    float(metadata['series'][0]['sequence']),
+                    metadata['series'][0]['id'])
+    else:
+        payload += (None, None, None, None)
+    return payload
+
+
+def diff_progress(item_id: str, media_progress: Optional[dict], current_status: BookRecord) -> Tuple[Optional[tuple], Optional[dict]]:
+    """Compare the reading progress on the kobo reader with ABS, the side that was updated last wins.
+
+    ABS progress without ebookProgress (e.g. of listening to the audio files) is no ebook progress, it never overwrites the reader.
+    Returns the kobo update payload (without ContentID) and the ABS progress update, at most one of them is set"""
+    kobo_finished = current_status.read_status == 2
+    kobo_progress = 1.0 if kobo_finished else (current_status.percent_read or 0) / 100
+    abs_finished = media_progress is not None and media_progress['isFinished']
+    has_abs_progress = abs_finished or (media_progress is not None and media_progress.get('ebookProgress') is not None)
+    abs_progress = 1.0 if abs_finished else media_progress['ebookProgress'] if has_abs_progress else 0
+    if kobo_finished == abs_finished and abs(kobo_progress - abs_progress) < PROGRESS_TOLERANCE:
+        return None, None
+    kobo_time = parse_kobo_date(current_status.date_last_read)
+    abs_time = media_progress['lastUpdate'] if media_progress is not None else 0
+    if kobo_time is not None and kobo_time > abs_time:
+        return None, {'libraryItemId': item_id, 'isFinished': kobo_finished, 'ebookProgress': kobo_progress, 'lastUpdate': kobo_time}
+    if has_abs_progress:
+        return (2 if abs_finished else (1 if abs_progress > 0 else 0), round(abs_progress * 100)), None
+    return None, None
+
+
+async def sync_metadata(args, db, target_lib, lib_items: Dict[str, dict], progress: Dict[str, dict], kobo_items: List[dict],
+                        all_items: List[dict]) -> List[dict]:
+    """Sync metadata of the given kobo items and reading progress of all synced items, writing all kobo changes in a single transaction.
+
+    The metadataSynced of a kobo item is set to the updatedAt of the applied ABS item once its metadata is on the reader, items the reader
+    did not import yet keep their old value. Returns the progress updates that have to be sent to ABS"""
+    content = await load_kobo_content(db, target_lib)
+    metadata_updates = []
+    progress_updates = []
+    abs_updates = []
+    applied = []
+    for kobo_item in kobo_items:
+        item = lib_items.get(kobo_item['id'])
+        if item is None or kobo_item.get('file') is None:
+            continue
+        content_id = get_content_id(target_lib, kobo_item['folder'], kobo_item['file'])
+        current_status = content.get(content_id)
+        if current_status is None:
+            # not yet imported by the kobo reader
+            continue
+        payload = diff_metadata(item, current_status)
+        if payload is not None:
+            metadata_updates.append(payload + (content_id,))
+        applied.append((kobo_item, item['updatedAt']))
+    if not args.no_progress_sync:
+        for entry in all_items:
+            if entry.get('file') is None:
+                continue
+            content_id = get_content_id(target_lib, entry['folder'], entry['file'])
+            current_status = content.get(content_id)
+            if current_status is None:
+                continue
+            kobo_update, abs_update = diff_progress(entry['id'], progress.get(entry['id']), current_status)
+            if kobo_update is not None:
+                progress_updates.append(kobo_update + (content_id,))
+            if abs_update is not None:
+                abs_updates.append(abs_update)
+    if len(metadata_updates) == 0 and len(progress_updates) == 0:
+        for kobo_item, updated_at in applied:
+            kobo_item['metadataSynced'] = updated_at
+        print(f'{Fore.LIGHTCYAN_EX}No metadata or reading progress changes on kobo reader')
+        return abs_updates
+    changes_before = db.total_changes
+    try:
+        if len(metadata_updates) > 0:
+            await db.executemany(METADATA_QUERY, metadata_updates)
+        if len(progress_updates) > 0:
+            await db.executemany(PROGRESS_QUERY, progress_updates)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    for kobo_item, updated_at in applied:
+        kobo_item['metadataSynced'] = updated_at
+    print(f'{Fore.LIGHTCYAN_EX}Updated metadata and reading progress of {Fore.GREEN}{db.total_changes - changes_before}{Fore.LIGHTCYAN_EX} '
+          f'item{'s' if db.total_changes - changes_before != 1 else ''} on kobo reader')
+    return abs_updates
+
+
+async def expand_items(client: ABSApi, item_ids: List[str], library: Optional[LibraryCache] = None) -> Dict[str, dict]:
+    """Get the expanded data of the given items keyed by item id, through library if given so readers share it"""
+    if library is not None:
+        return await library.expand(item_ids)
+    return {d['id']: d async for d in client.iter_library_items_batch(item_ids, fields=ITEM_FIELDS)}
+
+
+async def get_library_snapshot(args, client: ABSApi, target_lib, manifest: dict) -> Tuple[Dict[str, dict], bool, int]:
+    """Get the listed library items that need to be looked at.
+
+    If the manifest has a watermark from a previous sync only items updated since then are fetched, as long as the library item count
+    shows that no item was removed in the meantime. Returns the items, whether the listing is complete and the library item count."""
+    watermark = manifest.get('watermark')
+    # verification can turn any item into a missing one, so it needs the complete listing
+    if not args.full and not args.verify and not args.verify_hash and watermark is not None:
+        since = await client.get_library_items_since(target_lib['id'], watermark['updatedAt'], page_size=args.page_size,
+                                                     fields=LISTING_FIELDS)
+        if since is None:
+            print(f'{Fore.LIGHTCYAN_EX}Audiobookshelf did not sort the items by update time, doing a full sync...')
+        else:
+            changed, total = since
+            added = len([i for i in changed if i['addedAt'] > watermark['updatedAt']])
+            if total == watermark['total'] + added:
+                print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(changed)}{Fore.LIGHTCYAN_EX} changed items in audiobookshelf')
+                return {d['id']: d for d in changed}, False, total
+            print(f'{Fore.LIGHTCYAN_EX}Items were removed from audiobookshelf since the last sync, doing a full sync...')
+    lib_items = {d['id']: d async for d in client.iter_library_items(target_lib['id'], page_size=args.page_size, fields=LISTING_FIELDS)}
+    print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(lib_items)}{Fore.LIGHTCYAN_EX} items in audiobookshelf')
+    return lib_items, True, len(lib_items)
+
+
+def select_ebook_items(target_lib, lib_items: Dict[str, dict]) -> Dict[str, dict]:
+    """Only keep the items that have an ebook file, raises SyncError if the server did not send the ebook files at all"""
+    for item in lib_items.values():
+        if 'ebookFile' not in item.get('media', {}):
+            raise SyncError(f'Audiobookshelf did not send the ebook file of item {item["id"]} in library {target_lib["name"]}, '
+                            f'this server version is not supported')
+    ebook_items = {i: d for i, d in lib_items.items() if d['media']['ebookFile'] is not None}
+    if len(ebook_items) < len(lib_items):
+        skipped = len(lib_items) - len(ebook_items)
+        print(f'{Fore.LIGHTCYAN_EX}Skipping {Fore.GREEN}{skipped}{Fore.LIGHTCYAN_EX} item{'s' if skipped != 1 else ''} without ebook file')
+    return ebook_items
+
+
+def is_file_changed(entry: dict, item: dict) -> bool:
+    """Check if the ebook file of an item changed on the server since it was synced, entries of unknown state count as unchanged"""
+    if entry['ino'] is None:
+        return False
+    efile = item['media']['ebookFile']
+    return entry['ino'] != efile['ino'] or entry['size'] != efile['metadata']['size'] or entry['folder'] != item['relPath']
+
+
+async def sync_covers(args, client: ABSApi, fs: AsyncFS, pool: ProcessPoolExecutor, target_lib, entries: List[dict]) -> int:
+    """Render the kobo thumbnails of the covers of the given entries into the image cache of the reader.
+
+    Covers are requested with the ETag of the last sync, so unchanged covers are not transferred or rendered again.
+    Returns the number of rendered covers"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(args.jobs)
+    rendered = 0
+
+    async def _sync_cover(entry: dict):
+        nonlocal rendered
+        async with semaphore:
+            try:
+                data, etag = await client.get_cover(entry['id'], (entry.get('cover') or {}).get('etag'))
+                if data is not None:
+                    thumbnails = await loop.run_in_executor(pool, render_thumbnails, data)
+                    image_id = get_image_id(get_content_id(target_lib, entry['folder'], entry['file']))
+                    await fs.run(write_thumbnails, get_image_dir(args.kobo_dir, image_id), image_id, thumbnails)
+                    STATS.record_files(len(thumbnails))
+                    rendered += 1
+            except Exception as e:
+                display_error(f'Could not render the cover of item {entry["id"]}: {e}')
+                return
+            entry['cover'] = {'etag': etag}
+    await asyncio.gather(*[_sync_cover(e) for e in entries])
+    return rendered
+
+
+def merge_progress_updates(updates: List[dict]) -> List[dict]:
+    """Keep only the latest progress update per item, multiple readers can report progress of the same item"""
+    latest = {}
+    for update in updates:
+        current = latest.get(update['libraryItemId'])
+        if current is None or update['lastUpdate'] > current['lastUpdate']:
+            latest[update['libraryItemId']] = update
+    return list(latest.values())
+
+
+async def push_progress(args, client: ABSApi, abs_updates: List[dict]):
+    if len(abs_updates) == 0:
+        return
+    with STATS.phase('progress upload'):
+        await client.update_media_progress(abs_updates, batch_size=args.progress_batch_size)
+    print(f'{Fore.LIGHTCYAN_EX}Updated reading progress of {Fore.GREEN}{len(abs_updates)}{Fore.LIGHTCYAN_EX} '
+          f'item{'s' if len(abs_updates) != 1 else ''} in audiobookshelf')
+
+
+async def sync_device(args, client: ABSApi, fs: AsyncFS, target_lib: dict, library: Optional[LibraryCache] = None,
+                      progress: Optional[Dict[str, dict]] = None, downloads: Optional[DownloadCache] = None,
+                      cover_pool: Optional[ProcessPoolExecutor] = None) -> List[dict]:
+    """Sync the target library to the kobo reader mounted at args.kobo_dir and return the reading progress updates for ABS.
+
+    The library listing is taken from library, the reading progress from progress and the item downloads are shared through
+    downloads if given, otherwise they get requested for this reader alone. Covers are rendered in cover_pool if given.
+    Raises SyncError if the reader can not be synced."""
+    await fs.run(check_kobo_dir, args.kobo_dir)
+    lib_dir = get_library_dir(args, target_lib)
+    with STATS.phase('kobo tree'):
+        manifest = await build_kobo_tree(args, fs, target_lib)
+    kobo_items = manifest['items']
     print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(kobo_items)}{Fore.LIGHTCYAN_EX} items on kobo reader')
-    kobo_item_ids = [k['id'] for k in kobo_items]
-    # TODO check if existing kobo items are up to date
-    unexpected_items = [i for i in kobo_items if i['id'] not in lib_items.keys()]
+    print(f'{Fore.LIGHTCYAN_EX}Collect items from library {Fore.GREEN}{target_lib["name"]}{Fore.LIGHTCYAN_EX}...')
+    with STATS.phase('library listing'):
+        snapshot = library.snapshot() if library is not None else get_library_snapshot(args, client, target_lib, manifest)
+        if progress is None:
+            (lib_items, complete, total), progress = await asyncio.gather(snapshot, client.get_media_progress())
+        else:
+            lib_items, complete, total = await snapshot
+        # only items that are missing, changed or whose metadata is still pending need their expanded data, with an incremental
+        # listing the pending items that did not change in ABS are not part of it
+        needed = [i for i, d in lib_items.items()
+                  if args.full or i not in kobo_items or kobo_items[i].get('metadataSynced') != d['updatedAt']]
+        needed += [i for i, e in kobo_items.items() if i not in lib_items and e.get('metadataSynced') is None]
+        expanded = await expand_items(client, needed, library)
+    # the watermark also has to move past items that are skipped for lack of an ebook file
+    newest = max([i['updatedAt'] for i in lib_items.values()], default=0)
+    items = select_ebook_items(target_lib, expanded)
+    lib_items = {i: d for i, d in lib_items.items() if i not in expanded or i in items}
+    unexpected_items = [i for i in kobo_items.values() if i['id'] not in lib_items] if complete else []
     if len(unexpected_items) > 0:
         print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(unexpected_items)}{Fore.LIGHTCYAN_EX} unexpected '
               f'item{'s' if len(unexpected_items) > 1 else ''} on kobo reader:')
         for item in unexpected_items:
-            await remove_item(item)
-    else:
+            del kobo_items[item['id']]
+    elif complete:
         print(f'{Fore.LIGHTCYAN_EX}No unexpected items on kobo reader')
-    missing_items = [d for i, d in lib_items.items() if i not in kobo_item_ids]
-    if len(missing_items) > 0:
-        print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(missing_items)}{Fore.LIGHTCYAN_EX} item{'s' if len(missing_items) > 1 else ''} '
-              f'missing from kobo reader:')
+    outdated_items = [kobo_items.pop(i) for i, d in items.items() if i in kobo_items and is_file_changed(kobo_items[i], d)]
+    if len(outdated_items) > 0:
+        print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(outdated_items)}{Fore.LIGHTCYAN_EX} '
+              f'item{'s' if len(outdated_items) > 1 else ''} with changed files:')
+    missing_items = [items[i] for i in lib_items if i not in kobo_items and i in items]
+    # removals run alongside the downloads, unless a download is going to reuse the folder or replaces the files of a changed item,
+    # the entry of an item that could not be removed stays in the manifest so the removal is retried on the next run
+    target_folders = {d['relPath'] for d in missing_items}
+    blocking = [i for i in unexpected_items if i['folder'] in target_folders] + outdated_items
+    concurrent = [i for i in unexpected_items if i['folder'] not in target_folders]
+    with STATS.phase('downloads'):
+        removed = await asyncio.gather(*[remove_item(fs, lib_dir, i) for i in blocking])
+        not_removed = [e for e, ok in zip(blocking, removed) if not ok]
+        if len(not_removed) > 0:
+            kept = {e['id'] for e in not_removed} | {e['folder'] for e in not_removed}
+            missing_items = [d for d in missing_items if d['id'] not in kept and d['relPath'] not in kept]
+        removals = asyncio.gather(*[remove_item(fs, lib_dir, i) for i in concurrent])
+        if len(missing_items) > 0:
+            print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(missing_items)}{Fore.LIGHTCYAN_EX} item{'s' if len(missing_items) > 1 else ''} '
+                  f'missing from kobo reader:')
+            synced_items = await sync_missing_items(args, client, fs, target_lib, missing_items, downloads)
+            for entry in outdated_items:
+                # the rendered cover stays valid as long as the path of the ebook file did not change
+                synced = synced_items.get(entry['id'])
+                if synced is not None and (synced['folder'], synced['file']) == (entry['folder'], entry.get('file')):
+                    synced['cover'] = entry.get('cover')
+            kobo_items.update(synced_items)
+        else:
+            synced_items = {}
+            print(f'{Fore.LIGHTCYAN_EX}No items missing from kobo reader')
+        removed = await removals
+        not_removed += [e for e, ok in zip(concurrent, removed) if not ok]
+        kobo_items.update({e['id']: e for e in not_removed})
+    # an item whose old files could not be removed keeps its old metadataSynced, so it is looked at again on the next run
+    skipped = {e['id'] for e in not_removed}
+    # sync metadata of items that changed since it was last applied and of items the reader had not imported yet at the last sync
+    watermark = manifest.get('watermark') if not args.full else None
+    existing_items = [e for i, e in kobo_items.items() if i in items and i not in skipped]
+    changed = {e['id'] for e in existing_items if e.get('metadataSynced') is not None}
+    print(f'{Fore.LIGHTCYAN_EX}Syncing metadata of {Fore.GREEN}{len(existing_items)}{Fore.LIGHTCYAN_EX} '
+          f'item{'s' if len(existing_items) != 1 else ''} and reading progress...')
+    for entry in existing_items:
+        if entry.get('file') is None:
+            entry['file'] = items[entry['id']]['media']['ebookFile']['metadata']['relPath']
+    with STATS.phase('metadata sync'):
+        # connecting would create an empty database if the reader was unplugged in the meantime
+        await fs.run(check_kobo_dir, args.kobo_dir)
+        db = await aiosqlite.connect(str(os.path.join(args.kobo_dir, '.kobo', 'KoboReader.sqlite')))
+        try:
+            await db.set_trace_callback(STATS.record_sqlite)
+            abs_updates = await sync_metadata(args, db, target_lib, items, progress, existing_items,
+                                               [e for i, e in kobo_items.items() if i not in skipped])
+        finally:
+            # an open connection would keep the process alive after a failed reader
+            await db.close()
+    if cover_pool is not None:
+        # new items, changed items and items without rendered cover
+        cover_items = [e for i, e in kobo_items.items()
+                       if e.get('file') is not None and i not in skipped and (i in synced_items or i in changed or e.get('cover') is None)]
+        print(f'{Fore.LIGHTCYAN_EX}Checking covers of {Fore.GREEN}{len(cover_items)}{Fore.LIGHTCYAN_EX} '
+              f'item{'s' if len(cover_items) != 1 else ''}...')
+        with STATS.phase('covers'):
+            rendered = await sync_covers(args, client, fs, cover_pool, target_lib, cover_items)
+        print(f'{Fore.LIGHTCYAN_EX}Rendered {Fore.GREEN}{rendered}{Fore.LIGHTCYAN_EX} cover{'s' if rendered != 1 else ''} '
+              f'on kobo reader')
+    if len(synced_items) == len(missing_items) and len(not_removed) == 0:
+        # only move the watermark forward if nothing failed, failed items get picked up again on the next run
+        manifest['watermark'] = {
+            'updatedAt': max([newest] + ([watermark['updatedAt']] if watermark is not None else [])),
+            'total': total
+        }
+    with STATS.phase('manifest'):
+        await fs.run(save_manifest, lib_dir, manifest)
+        STATS.record_files()
+    return abs_updates
+
+
+async def sync_reader_libraries(args, client: ABSApi, fs: AsyncFS, target_libs: List[dict], libraries: Dict[str, LibraryCache],
+                                progress: Dict[str, dict], downloads: DownloadCache,
+                                cover_pool: Optional[ProcessPoolExecutor] = None) -> List[dict]:
+    """Sync all target libraries to one kobo reader, one after another as they share the reader database"""
+    abs_updates = []
+    for target_lib in target_libs:
+        print(f'{Fore.LIGHTCYAN_EX}Syncing library {Fore.GREEN}{target_lib["name"]}{Fore.LIGHTCYAN_EX} to kobo reader at '
+              f'{Fore.GREEN}{args.kobo_dir}{Style.RESET_ALL}')
+        abs_updates += await sync_device(args, client, fs, target_lib, libraries[target_lib['id']], progress, downloads, cover_pool)
+    return abs_updates
+
+
+@contextmanager
+def open_cover_pool(args):
+    """Process pool for rendering covers if requested and Pillow is installed"""
+    if not args.covers:
+        yield None
+    elif not has_image_support():
+        display_error('Rendering covers needs Pillow (pip install pillow), covers are skipped')
+        yield None
     else:
-        print(f'{Fore.LIGHTCYAN_EX}No items missing from kobo reader')
-    for missing_item in missing_items:
-        await sync_item(args, client, target_lib, missing_item)
-    # sync metadata and progress of existing items
-    print(f'{Fore.LIGHTCYAN_EX}Syncing metadata and progress of previously existing items...')
-    for kobo_item in kobo_items:
-        await sync_metadata(args, client, db, target_lib, lib_items[kobo_item['id']], kobo_item)
-    # TODO sync progress kobo -> abs
-    await db.close()
-    print(f'{Fore.GREEN}Done{Style.RESET_ALL}')
+        with ProcessPoolExecutor(args.cover_workers) as pool:
+            yield pool
 
 
-def kobo_sync_action(args, cfg):
-    asyncio.run(kobo_sync(args))
+@asynccontextmanager
+async def open_download_cache(args, client: ABSApi, shared: bool):
+    """Open the persistent ebook cache, with --no-cache readers synced together still share downloads through a temporary one"""
+    if not args.no_cache:
+        downloads = DownloadCache(client, args.cache_dir or get_ebook_cache_dir(), args.cache_size * 1024 * 1024)
+        try:
+            yield downloads
+        finally:
+            await downloads.close()
+    elif shared:
+        with tempfile.TemporaryDirectory(prefix='abs_util_') as download_dir:
+            yield DownloadCache(client, download_dir)
+    else:
+        yield None
 
 
-def kobo_sync_parser(sub_parser, cfg):
-    parser = sub_parser.add_parser('kobo-sync', help='Sync a library with a USB connected Kobo Reader',
-                                   formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100, width=360))
-    parser.set_defaults(func=kobo_sync_action)
-    add_default_args(parser, cfg, 'library', required_override=True)
-    add_default_args(parser, cfg, 'kobo-dir')
-    add_default_args(parser, cfg, 'base-api')
-    parser.add_argument('--no-progress-sync', action='store_true', default=False, help='Do not sync reading progress')
+async def kobo_sync(args):
+    names = args.library if isinstance(args.library, list) else [args.library]
+    kobo_dirs = args.kobo_dir if isinstance(args.kobo_dir, list) else [args.kobo_dir]
+    # a reader that fails once the syncs run must not stop the others, so obvious mistakes are caught before anything starts
+    invalid = False
+    for kobo_dir in kobo_dirs:
+        try:
+            check_kobo_dir(kobo_dir)
+        except SyncError as e:
+            display_error(str(e))
+            invalid = True
+    if invalid:
+        sys.exit(1)
+    failed = []
+    with AsyncFS(args.fs_workers) as fs:
+        async with ABSApi(args.server) as client:
+            with STATS.phase('login'):
+                await client.authorize(args.user, args.password)
+            target_libs = await get_target_libs(client, names)
+            abs_updates = []
+            with open_cover_pool(args) as cover_pool:
+                async with open_download_cache(args, client, shared=len(kobo_dirs) > 1) as downloads:
+                    if len(kobo_dirs) == 1:
+                        # a single reader only needs the items that changed since its last sync
+                        try:
+                            for target_lib in target_libs:
+                                abs_updates += await sync_device(device_args(args, kobo_dirs[0]), client, fs, target_lib,
+                                                                 downloads=downloads, cover_pool=cover_pool)
+                        except SyncError as e:
+                            display_error(str(e))
+                            failed.append(kobo_dirs[0])
+                    else:
+                        # fetch every library and the reading progress once and share them between all readers
+                        libraries = {lib['id']: LibraryCache(client, lib, page_size=args.page_size, fields=LISTING_FIELDS,
+                                                             item_fields=ITEM_FIELDS) for lib in target_libs}
+                        print(f'{Fore.LIGHTCYAN_EX}Collect items of {Fore.GREEN}{len(libraries)}{Fore.LIGHTCYAN_EX} '
+                              f'librar{'ies' if len(libraries) != 1 else 'y'} for {Fore.GREEN}{len(kobo_dirs)}{Fore.LIGHTCYAN_EX} '
+                              f'kobo readers...')
+                        with STATS.phase('library listing'):
+                            progress = (await asyncio.gather(client.get_media_progress(), *[c.refresh() for c in libraries.values()]))[0]
+                        # a failing reader is reported once the others are done, their manifests still get saved
+                        results = await asyncio.gather(*[sync_reader_libraries(device_args(args, kobo_dir), client, fs, target_libs, libraries,
+                                                                               progress, downloads, cover_pool) for kobo_dir in kobo_dirs],
+                                                       return_exceptions=True)
+                        for kobo_dir, result in zip(kobo_dirs, results):
+                            if isinstance(result, BaseException):
+                                display_error(f'Syncing kobo reader at {kobo_dir} failed: {result}')
+                                failed.append(kobo_dir)
+                            else:
+                                abs_updates += result
+            await push_progress(args, client, merge_progress_updates(abs_updates))
+    if len(failed) > 0:
+        sys.exit(1)
+    print(f'{Fore.GREEN}Done{Style.RESET_ALL}')
+
 
+def kobo_sync_action(args, cfg):
+    asyncio.run(kobo_sync(args))
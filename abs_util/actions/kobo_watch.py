@@ -0,0 +1,97 @@
+import asyncio
+import getpass
+import os
+import platform
+import string
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from colorama import Fore, Style
+
+from abs_util.util import display_error
+from abs_util.api import ABSApi
+from abs_util.fs import AsyncFS
+from abs_util.stats import STATS
+from abs_util.library_cache import LibraryCache
+from abs_util.actions.kobo_sync import LISTING_FIELDS, ITEM_FIELDS, get_target_lib, device_args, sync_device, push_progress, \
+    open_download_cache, open_cover_pool
+
+
+def get_mount_roots() -> List[str]:
+    """Directories in which removable devices usually get mounted on this system"""
+    system = platform.system()
+    if system == 'Windows':
+        return [f'{letter}:\\' for letter in string.ascii_uppercase]
+    if system == 'Darwin':
+        return ['/Volumes']
+    user = getpass.getuser()
+    return [f'/media/{user}', f'/run/media/{user}', '/media', '/mnt']
+
+
+def is_kobo_reader(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, '.kobo', 'KoboReader.sqlite'))
+
+
+def find_readers(roots: List[str]) -> List[str]:
+    """Find mounted kobo readers, every root can either be a reader itself or contain readers"""
+    readers = []
+    for root in roots:
+        if is_kobo_reader(root):
+            readers.append(root)
+            continue
+        try:
+            with os.scandir(root) as entries:
+                readers.extend(e.path for e in entries if e.is_dir() and is_kobo_reader(e.path))
+        except OSError:
+            # root does not exist or is not readable
+            continue
+    return readers
+
+
+async def sync_reader(args, client: ABSApi, fs: AsyncFS, library: LibraryCache, kobo_dir: str,
+                      cover_pool: Optional[ProcessPoolExecutor] = None):
+    print(f'{Fore.LIGHTCYAN_EX}Kobo reader connected at {Fore.GREEN}{kobo_dir}{Style.RESET_ALL}')
+    try:
+        # one request for the items changed since the last refresh brings the cached listing up to date
+        await library.refresh()
+        # closing the ebook cache after every reader enforces its size limit between syncs, the files stay cached on disk
+        async with open_download_cache(args, client, shared=False) as downloads:
+            abs_updates = await sync_device(device_args(args, kobo_dir), client, fs, library.target_lib, library, downloads=downloads,
+                                          cover_pool=cover_pool)
+        await push_progress(args, client, abs_updates)
+        print(f'{Fore.GREEN}Done{Style.RESET_ALL}')
+    except Exception as e:
+        display_error(f'Syncing kobo reader at {kobo_dir} failed: {e}')
+
+
+async def kobo_watch(args):
+    with AsyncFS(args.fs_workers) as fs:
+        async with ABSApi(args.server) as client:
+            with STATS.phase('login'):
+                await client.authorize(args.user, args.password)
+            target_lib = await get_target_lib(args, client)
+            library = LibraryCache(client, target_lib, page_size=args.page_size, fields=LISTING_FIELDS, item_fields=ITEM_FIELDS)
+            print(f'{Fore.LIGHTCYAN_EX}Loading library {Fore.GREEN}{target_lib["name"]}{Fore.LIGHTCYAN_EX}...')
+            with STATS.phase('library listing'):
+                await library.refresh()
+            print(f'{Fore.LIGHTCYAN_EX}Found {Fore.GREEN}{len(library.items)}{Fore.LIGHTCYAN_EX} items in audiobookshelf')
+            refresher = asyncio.create_task(library.keep_fresh(args.refresh_interval))
+            roots = args.mount_root if args.mount_root is not None else get_mount_roots()
+            print(f'{Fore.LIGHTCYAN_EX}Waiting for kobo readers in {Fore.GREEN}{", ".join(roots)}{Fore.LIGHTCYAN_EX}, '
+                  f'press Ctrl+C to stop{Style.RESET_ALL}')
+            # readers that were mounted at the last check, a reader is only synced again after it was unplugged
+            connected = set()
+            try:
+                with open_cover_pool(args) as cover_pool:
+                    while True:
+                        readers = set(await fs.run(find_readers, roots))
+                        for kobo_dir in sorted(readers - connected):
+                            await sync_reader(args, client, fs, library, kobo_dir, cover_pool)
+                        connected = readers
+                        await asyncio.sleep(args.poll_interval)
+            finally:
+                refresher.cancel()
+
+
+def kobo_watch_action(args, cfg):
+    asyncio.run(kobo_watch(args))
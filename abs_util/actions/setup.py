@@ -1,11 +1,21 @@
-import argparse
+import asyncio
 import json
 
 from prompt_toolkit.shortcuts import prompt
 from prompt_toolkit.styles import Style
 from prompt_toolkit.output import ColorDepth
+from colorama import Fore
 
-from abs_util.util import add_default_args, get_config_file_path
+from abs_util.api import ABSApi
+from abs_util.stats import STATS
+from abs_util.util import get_config_file_path, display_error
+
+
+async def login(server: str, user: str, password: str):
+    """Log in once so the access token gets cached, the password itself is never stored"""
+    async with ABSApi(server) as client:
+        with STATS.phase('login'):
+            await client.authorize(user, password)
 
 
 def setup_action(args, cfg):
@@ -42,17 +52,20 @@ def setup_action(args, cfg):
         ]
         password = prompt(message, style=stype, color_depth=ColorDepth.TRUE_COLOR)
 
+    server = server if len(server) > 0 else args.server
+    user = user if len(user) > 0 else args.user
+    password = password if len(password) > 0 else args.password
+    if password is not None:
+        try:
+            asyncio.run(login(server, user, password))
+        except Exception as e:
+            display_error(f'Login failed: {e}')
+            return
+        print(f'{Fore.GREEN}Login successful')
+
     config_file = get_config_file_path()
     with open(config_file, 'w') as _f:
         json.dump({
-            'server': server if len(server) > 0 else args.server,
-            'user': user if len(user) > 0 else args.user,
-            'password': password if len(password) > 0 else args.password
+            'server': server,
+            'user': user
         }, _f)
-
-
-def setup_parser(sub_parser, cfg: dict):
-    parser = sub_parser.add_parser('setup', help='Setup basic settings',
-                                   formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100, width=360))
-    parser.set_defaults(func=setup_action)
-    add_default_args(parser, cfg, 'base-api')
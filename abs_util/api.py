@@ -0,0 +1,383 @@
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import List, Dict, Optional, Tuple, AsyncIterator, Iterable
+
+from aiohttp import ClientSession, ClientResponse, TCPConnector
+
+from abs_util.fs import AsyncFS
+from abs_util.stats import STATS
+from abs_util.util import LIBRARY_PAGE_SIZE, PROGRESS_BATCH_SIZE, ITEM_BATCH_SIZE, get_token_cache_path, display_error
+
+
+CONNECTION_LIMIT = 10
+KEEPALIVE_TIMEOUT = 60
+# renew access tokens that expire within this many seconds
+TOKEN_EXPIRY_MARGIN = 60
+# downloaded data is collected into chunks of this size before it is written
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def select_fields(data: dict, fields: Iterable[str]) -> dict:
+    """Reduce data to the given fields, nested fields are addressed with dots (e.g. media.metadata.title)"""
+    result = {}
+    for field in fields:
+        source = data
+        target = result
+        keys = field.split('.')
+        for key in keys[:-1]:
+            source = source.get(key)
+            if not isinstance(source, dict):
+                break
+            target = target.setdefault(key, {})
+        else:
+            if keys[-1] in source:
+                target[keys[-1]] = source[keys[-1]]
+    return result
+
+
+class ABSApiError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_token_expiry(token: str) -> Optional[int]:
+    """Read the exp claim of a JWT without verifying it, returns None if the token has no expiry"""
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))).get('exp')
+    except (IndexError, ValueError):
+        return None
+
+
+def load_tokens(server: str, user: str) -> Optional[dict]:
+    try:
+        with open(get_token_cache_path(), 'r') as _f:
+            return json.load(_f).get(f'{server}|{user}')
+    except (OSError, ValueError):
+        return None
+
+
+def save_tokens(server: str, user: str, tokens: Optional[dict]):
+    path = get_token_cache_path()
+    try:
+        with open(path, 'r') as _f:
+            cache = json.load(_f)
+    except (OSError, ValueError):
+        cache = {}
+    if tokens is None:
+        cache.pop(f'{server}|{user}', None)
+    else:
+        cache[f'{server}|{user}'] = tokens
+    # the cache holds credentials, so only the user may read it
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as _f:
+        json.dump(cache, _f)
+    os.replace(path + '.tmp', path)
+
+
+class ABSApi:
+    """Lightweight Audiobookshelf API client with support for the paginated and bulk endpoints used by the sync actions.
+
+    All requests of one instance share a single keep-alive connection pool. Access tokens are cached in the user config dir,
+    refreshed when they expire and only renewed with a full login if the server rejects them."""
+
+    def __init__(self, server: str, connection_limit: int = CONNECTION_LIMIT):
+        self.server = server.rstrip('/')
+        self._connection_limit = connection_limit
+        self._user: Optional[str] = None
+        self._password: Optional[str] = None
+        self._token: Optional[str] = None
+        self._refresh_token: Optional[str] = None
+        self._auth_lock = asyncio.Lock()
+        self._session: Optional[ClientSession] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def _get_session(self) -> ClientSession:
+        if self._session is None:
+            connector = TCPConnector(limit=self._connection_limit, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self._session = ClientSession(connector=connector, auto_decompress=True, headers={'Accept-Encoding': 'gzip, deflate'})
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _check_response(self, response: ClientResponse):
+        if response.status >= 400:
+            raise ABSApiError(response.status, await response.text())
+
+    @asynccontextmanager
+    async def _send(self, method: str, path: str, params: Optional[dict] = None, data=None, headers: Optional[dict] = None):
+        """Send an authorized request, renewing the access token once if the server rejects it"""
+        for attempt in range(2):
+            token = self._token
+            request_headers = {} if headers is None else dict(headers)
+            if token is not None:
+                request_headers['Authorization'] = f'Bearer {token}'
+            start = time.perf_counter()
+            async with self._get_session().request(method, f'{self.server}{path}', params=params, json=data,
+                                                   headers=request_headers) as response:
+                if response.status != 401 or attempt > 0 or self._user is None:
+                    try:
+                        yield response
+                    finally:
+                        STATS.record_api(method, path, time.perf_counter() - start)
+                    return
+            STATS.record_api(method, path, time.perf_counter() - start)
+            await self._reauthorize(token)
+
+    async def _request(self, method: str, path: str, params: Optional[dict] = None, data=None):
+        async with self._send(method, path, params=params, data=data) as response:
+            await self._check_response(response)
+            if response.content_type == 'application/json':
+                return await response.json()
+            return await response.text()
+
+    def _store_tokens(self, user_data: dict):
+        self._token = user_data.get('accessToken', user_data.get('token'))
+        self._refresh_token = user_data.get('refreshToken', self._refresh_token)
+        save_tokens(self.server, self._user, {'accessToken': self._token, 'refreshToken': self._refresh_token})
+
+    async def _login(self):
+        if self._password is None:
+            raise ABSApiError(401, 'no valid cached login, run setup again or pass a password')
+        async with self._get_session().post(f'{self.server}/login', json={'username': self._user, 'password': self._password},
+                                            headers={'x-return-tokens': 'true'}) as response:
+            await self._check_response(response)
+            data = await response.json()
+        self._store_tokens(data['user'])
+
+    async def _refresh(self) -> bool:
+        if self._refresh_token is None:
+            return False
+        async with self._get_session().post(f'{self.server}/auth/refresh', headers={'x-refresh-token': self._refresh_token}) as response:
+            if response.status >= 400:
+                self._refresh_token = None
+                return False
+            data = await response.json()
+        self._store_tokens(data['user'])
+        return True
+
+    async def _reauthorize(self, rejected_token: Optional[str]):
+        async with self._auth_lock:
+            if self._token != rejected_token:
+                # another request already renewed it
+                return
+            if not await self._refresh():
+                await self._login()
+
+    async def authorize(self, user: str, password: Optional[str] = None):
+        """Authorize with a cached access token if possible, the password is only needed if there is no usable cached login"""
+        self._user = user
+        self._password = password
+        tokens = load_tokens(self.server, user)
+        if tokens is not None:
+            self._refresh_token = tokens.get('refreshToken')
+            expiry = get_token_expiry(tokens['accessToken'])
+            if expiry is None or expiry > time.time() + TOKEN_EXPIRY_MARGIN:
+                self._token = tokens['accessToken']
+                return
+            if await self._refresh():
+                return
+        await self._login()
+
+    async def get_libraries(self) -> List[dict]:
+        data = await self._request('GET', '/api/libraries')
+        return data['libraries']
+
+    async def _iter_pages(self, path: str, result_key: str, page_size: int, params: Optional[dict] = None) \
+            -> AsyncIterator[Tuple[List[dict], Optional[int]]]:
+        """Walk a paginated list endpoint, yielding (results, total) per page.
+
+        The next page is already requested while the current one is processed. Responses without a total are treated as unpaginated."""
+        params = {} if params is None else params
+
+        async def _fetch(_page: int) -> dict:
+            return await self._request('GET', path, params={**params, 'limit': page_size, 'page': _page})
+
+        page = 0
+        seen = 0
+        next_page = asyncio.create_task(_fetch(page))
+        try:
+            while next_page is not None:
+                data = await next_page
+                next_page = None
+                results = data[result_key]
+                total = data.get('total')
+                seen += len(results)
+                if total is not None and page_size > 0 and len(results) == page_size and seen < total:
+                    page += 1
+                    next_page = asyncio.create_task(_fetch(page))
+                yield results, total
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def iter_library_items(self, library_id: str, page_size: int = LIBRARY_PAGE_SIZE, fields: Optional[Iterable[str]] = None,
+                                 sort: Optional[str] = None, desc: bool = False) -> AsyncIterator[dict]:
+        """Iterate over all items of a library page by page, only keeping the given fields (see select_fields) if specified"""
+        params = {'minified': 0}
+        if sort is not None:
+            params['sort'] = sort
+            params['desc'] = 1 if desc else 0
+        async for results, _ in self._iter_pages(f'/api/libraries/{library_id}/items', 'results', page_size, params):
+            for item in results:
+                yield item if fields is None else select_fields(item, fields)
+
+    async def get_library_items_since(self, library_id: str, updated_since: int, page_size: int = LIBRARY_PAGE_SIZE,
+                                      fields: Optional[Iterable[str]] = None) -> Optional[Tuple[List[dict], int]]:
+        """Get all items of a library updated after the given timestamp (in ms), newest first.
+
+        Returns the changed items and the total number of items in the library, or None if the server did not sort the listing by
+        updatedAt, in that case the changed items can not be found without the complete listing."""
+        items = []
+        total = 0
+        last = None
+        pages = self._iter_pages(f'/api/libraries/{library_id}/items', 'results', page_size,
+                                 {'minified': 0, 'sort': 'updatedAt', 'desc': 1})
+        try:
+            async for results, total in pages:
+                # servers that do not know the sort key send their default order, every fetched page is checked as a whole
+                updated = ([] if last is None else [last]) + [i['updatedAt'] for i in results]
+                if any(later > earlier for earlier, later in zip(updated, updated[1:])):
+                    return None
+                if len(results) > 0:
+                    last = results[-1]['updatedAt']
+                for item in results:
+                    if item['updatedAt'] <= updated_since:
+                        return items, total
+                    items.append(item if fields is None else select_fields(item, fields))
+        finally:
+            await pages.aclose()
+        return items, total
+
+    async def iter_library_authors(self, library_id: str, page_size: int = LIBRARY_PAGE_SIZE,
+                                   fields: Optional[Iterable[str]] = None) -> AsyncIterator[dict]:
+        async for results, _ in self._iter_pages(f'/api/libraries/{library_id}/authors', 'authors', page_size):
+            for author in results:
+                yield author if fields is None else select_fields(author, fields)
+
+    async def delete_author(self, author_id: str):
+        await self._request('DELETE', f'/api/authors/{author_id}')
+
+    async def iter_library_items_batch(self, item_ids: List[str], batch_size: int = ITEM_BATCH_SIZE,
+                                       fields: Optional[Iterable[str]] = None) -> AsyncIterator[dict]:
+        """Iterate over the expanded data of many items with one request per batch_size items, only keeping the given fields if specified.
+
+        Unlike the library listing the expanded items contain the ebook file and the complete series list. The next batch is already
+        requested while the current one is processed, so at most two responses are held in memory."""
+        batches = [item_ids[i:i + batch_size] for i in range(0, len(item_ids), batch_size)]
+
+        async def _fetch(_batch: List[str]) -> dict:
+            return await self._request('POST', '/api/items/batch/get', data={'libraryItemIds': _batch})
+
+        next_batch = asyncio.create_task(_fetch(batches[0])) if len(batches) > 0 else None
+        fetched = 0
+        try:
+            while next_batch is not None:
+                data = await next_batch
+                fetched += 1
+                next_batch = asyncio.create_task(_fetch(batches[fetched])) if fetched < len(batches) else None
+                for item in data['libraryItems']:
+                    yield item if fields is None else select_fields(item, fields)
+        finally:
+            if next_batch is not None:
+                next_batch.cancel()
+
+    async def get_cover(self, item_id: str, etag: Optional[str] = None) -> Tuple[Optional[bytes], Optional[str]]:
+        """Get the original cover image of an item and its ETag.
+
+        If etag is given and the cover did not change the image is None, items without cover return (None, None)"""
+        headers = {'If-None-Match': etag} if etag is not None else None
+        async with self._send('GET', f'/api/items/{item_id}/cover', params={'raw': 1}, headers=headers) as response:
+            if response.status == 304:
+                return None, etag
+            if response.status == 404:
+                return None, None
+            await self._check_response(response)
+            data = await response.read()
+            STATS.record_download(len(data))
+            return data, response.headers.get('ETag')
+
+    async def get_media_progress(self) -> Dict[str, dict]:
+        """Get the media progress of the current user, keyed by library item id"""
+        data = await self._request('GET', '/api/me')
+        return {p['libraryItemId']: p for p in data.get('mediaProgress', []) if p.get('episodeId') is None}
+
+    async def update_media_progress(self, updates: List[dict], batch_size: int = PROGRESS_BATCH_SIZE):
+        """Send media progress updates (each containing at least libraryItemId) in batches"""
+        for i in range(0, len(updates), batch_size):
+            await self._request('PATCH', '/api/me/progress/batch/update', data=updates[i:i + batch_size])
+
+    async def download_file(self, item_id: str, ino: str, target_path: str, expected_size: Optional[int] = None, fs: Optional[AsyncFS] = None):
+        """Download a file via a temporary .part file which is renamed to target_path once complete.
+
+        An existing .part file from an interrupted download is resumed with a HTTP range request.
+        File operations run on the given AsyncFS (or the default executor) so slow target devices do not block other requests.
+        Raises DownloadError if the final size does not match expected_size."""
+        run = fs.run if fs is not None else asyncio.to_thread
+        part_path = target_path + '.part'
+        offset = await run(lambda: os.path.getsize(part_path) if os.path.isfile(part_path) else 0)
+        if expected_size is not None and offset > expected_size:
+            offset = 0
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else None
+        async with self._send('GET', f'/api/items/{item_id}/file/{ino}/download', headers=headers) as response:
+            if response.status == 416 and offset == expected_size:
+                # the previous attempt got everything but the rename
+                pass
+            else:
+                await self._check_response(response)
+                _f = await run(open, part_path, 'ab' if response.status == 206 else 'wb')
+                try:
+                    buffer = bytearray()
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        STATS.record_download(len(chunk))
+                        buffer += chunk
+                        if len(buffer) >= WRITE_BUFFER_SIZE:
+                            await run(_f.write, bytes(buffer))
+                            buffer.clear()
+                    await run(_f.write, bytes(buffer))
+                    await run(_f.flush)
+                    await run(os.fsync, _f.fileno())
+                finally:
+                    await run(_f.close)
+        size = await run(os.path.getsize, part_path)
+        if expected_size is not None and size != expected_size:
+            if size > expected_size:
+                await run(os.remove, part_path)
+            raise DownloadError(f'expected {expected_size} bytes but got {size}')
+        await run(os.replace, part_path, target_path)
+        STATS.record_files()
+
+
+async def get_target_libs(client: ABSApi, names: List[str]) -> List[dict]:
+    """Find valid target libraries and return them in the given order"""
+    libs = {lib['name'].lower(): lib for lib in await client.get_libraries()}
+    target_libs = []
+    for name in names:
+        lib = libs.get(name.lower())
+        if lib is None:
+            display_error(f'Library {name} not found.')
+            sys.exit(1)
+        if lib['mediaType'] != 'book':
+            display_error(f'Library {lib["name"]} is not of type book.')
+            sys.exit(1)
+        target_libs.append(lib)
+    return target_libs
@@ -0,0 +1,129 @@
+import argparse
+import importlib
+from collections import namedtuple
+
+from abs_util.util import add_default_args, LIBRARY_PAGE_SIZE, PROGRESS_BATCH_SIZE, FS_WORKERS, EBOOK_CACHE_SIZE
+
+
+# an action is only described here, its module is imported once the action actually runs
+Command = namedtuple('Command', ['name', 'help', 'module', 'func', 'add_arguments'])
+
+
+def lazy_action(module: str, func: str):
+    def _run(args, cfg):
+        return getattr(importlib.import_module(module), func)(args, cfg)
+    return _run
+
+
+def positive_int(value: str) -> int:
+    """argparse type for counts that need at least one, like the number of parallel workers"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {value}')
+    return number
+
+
+def non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f'must not be negative, got {value}')
+    return number
+
+
+def setup_arguments(parser, cfg: dict):
+    add_default_args(parser, cfg, 'base-api')
+
+
+def clear_authors_arguments(parser, cfg: dict):
+    add_default_args(parser, cfg, 'base-api')
+    add_default_args(parser, cfg, 'library')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=8, help='Number of authors to remove in parallel')
+    parser.add_argument('--retries', type=non_negative_int, default=3, help='How often a failed removal should be retried')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='Only report which authors would be removed')
+
+
+def from_goodreads_arguments(parser, cfg: dict):
+    add_default_args(parser, cfg, 'base-api')
+    add_default_args(parser, cfg, 'library')
+    parser.add_argument('-libdir', '--library-dir', required=True, default=cfg.get('libdir'), help='The Library base directory')
+    parser.add_argument('--goodreads-series', required=False, help='The URL to a Goodreads series')
+    parser.add_argument('--series-file', default=None, help='Text file with one Goodreads series URL per line')
+    parser.add_argument('--goodreads-csv', default=None,
+                        help='Goodreads library export (CSV), folders are created for all series its books belong to')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=4, help='Number of Goodreads pages to fetch in parallel')
+    parser.add_argument('--rate', type=float, default=2, help='Maximum number of Goodreads requests per second')
+    parser.add_argument('--no-http-cache', action='store_true', default=False,
+                        help='Always fetch Goodreads pages again instead of revalidating cached copies')
+    parser.add_argument('--open-folder', required=False, action='store_true', default=False, help='Open the series folder after creating structure')
+
+
+def sync_options(parser):
+    """Options shared by all actions that sync a kobo reader"""
+    parser.add_argument('--no-progress-sync', action='store_true', default=False, help='Do not sync reading progress')
+    parser.add_argument('--progress-batch-size', type=positive_int, default=PROGRESS_BATCH_SIZE,
+                        help='Number of reading progress updates to send to audiobookshelf per request')
+    parser.add_argument('-j', '--jobs', type=positive_int, default=4, help='Number of items to fetch and download in parallel')
+    parser.add_argument('--retries', type=non_negative_int, default=3, help='How often a failed item download should be retried')
+    parser.add_argument('--page-size', type=positive_int, default=LIBRARY_PAGE_SIZE, help='Number of library items to request per page')
+    parser.add_argument('--fs-workers', type=positive_int, default=FS_WORKERS,
+                        help='Number of threads used for file operations on the kobo reader')
+    parser.add_argument('--full', action='store_true', default=False,
+                        help='Compare all items instead of only the ones that changed since the last sync')
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help='Check the size of all ebook files on the kobo reader and download incomplete ones again')
+    parser.add_argument('--verify-hash', action='store_true', default=False,
+                        help='Record a SHA-256 hash for downloaded ebook files and check existing files against it')
+    parser.add_argument('--rescan', action='store_true', default=False,
+                        help='Rebuild the sync manifest from the item files on the kobo reader instead of trusting it')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory in which downloaded ebooks are kept for later syncs (default: the user cache directory)')
+    parser.add_argument('--cache-size', type=non_negative_int, default=EBOOK_CACHE_SIZE,
+                        help='Size limit of the ebook cache in MiB, the least recently used ebooks are removed beyond it')
+    parser.add_argument('--no-cache', action='store_true', default=False, help='Do not keep downloaded ebooks for later syncs')
+    parser.add_argument('--covers', action='store_true', default=False,
+                        help='Render the cover thumbnails of synced items on this computer instead of on the kobo reader (needs Pillow)')
+    parser.add_argument('--cover-workers', type=positive_int, default=None,
+                        help='Number of processes used to render covers (default: number of CPUs)')
+
+
+def kobo_sync_arguments(parser, cfg: dict):
+    add_default_args(parser, cfg, 'library', required_override=True, multiple=True)
+    add_default_args(parser, cfg, 'kobo-dir', multiple=True)
+    add_default_args(parser, cfg, 'base-api')
+    sync_options(parser)
+
+
+def kobo_watch_arguments(parser, cfg: dict):
+    add_default_args(parser, cfg, 'library', required_override=True)
+    add_default_args(parser, cfg, 'base-api')
+    parser.add_argument('--mount-root', action='append', default=None,
+                        help='Directory in which readers get mounted, can be given multiple times (default: the usual mount locations '
+                             'of this system)')
+    parser.add_argument('--poll-interval', type=float, default=2, help='Seconds between checks for newly mounted readers')
+    parser.add_argument('--refresh-interval', type=float, default=300,
+                        help='Seconds between background refreshes of the cached library listing')
+    sync_options(parser)
+
+
+COMMANDS = [
+    Command('setup', 'Setup basic settings', 'abs_util.actions.setup', 'setup_action', setup_arguments),
+    Command('clear-authors', 'Remove authors with no books from either all or selected libraries',
+            'abs_util.actions.clear_authors', 'clear_authors_action', clear_authors_arguments),
+    Command('goodreads-folder-import', 'Create Folders from Goodreads Series Link',
+            'abs_util.actions.folder_from_goodreads', 'from_goodreads_action', from_goodreads_arguments),
+    Command('kobo-sync', 'Sync a library with a USB connected Kobo Reader', 'abs_util.actions.kobo_sync', 'kobo_sync_action',
+            kobo_sync_arguments),
+    Command('kobo-watch', 'Wait for Kobo Readers to be connected and sync a library with them', 'abs_util.actions.kobo_watch',
+            'kobo_watch_action', kobo_watch_arguments),
+]
+
+
+def add_command_parsers(sub_parser, cfg: dict):
+    for command in COMMANDS:
+        parser = sub_parser.add_parser(command.name, help=command.help,
+                                       formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=100, width=360))
+        parser.set_defaults(func=lazy_action(command.module, command.func))
+        command.add_arguments(parser, cfg)
+        parser.add_argument('--stats', action='store_true', default=False,
+                            help='Print per phase timings, API latencies and I/O counters after the run')
+        parser.add_argument('--stats-json', default=None, metavar='PATH', help='Write the run statistics as JSON to this file')
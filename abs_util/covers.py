@@ -0,0 +1,68 @@
+import importlib.util
+import io
+import os
+from typing import Dict
+
+
+KOBO_IMAGES_DIR = '.kobo-images'
+
+# thumbnails the reader renders for every book, file name ending -> maximum (width, height)
+COVER_SIZES = {
+    ' - N3_FULL.parsed': (1072, 1448),
+    ' - N3_LIBRARY_FULL.parsed': (355, 530),
+    ' - N3_LIBRARY_GRID.parsed': (149, 223),
+    ' - N3_LIBRARY_LIST.parsed': (60, 90)
+}
+
+COVER_QUALITY = 90
+
+
+def get_image_id(content_id: str) -> str:
+    """ImageId the kobo firmware derives from a ContentID"""
+    return content_id.replace('/', '_').replace(':', '_').replace('.', '_').replace(' ', '_')
+
+
+def qhash(text: str) -> int:
+    """Qt's qHash of a string, the firmware uses it to spread images over directories"""
+    h = 0
+    for c in text.encode('utf-8'):
+        h = (h << 4) + c
+        h ^= (h & 0xf0000000) >> 23
+        h &= 0x0fffffff
+    return h
+
+
+def get_image_dir(kobo_dir: str, image_id: str) -> str:
+    h = qhash(image_id)
+    return os.path.join(kobo_dir, KOBO_IMAGES_DIR, str(h & 0xff), str((h & 0xff00) >> 8))
+
+
+def has_image_support() -> bool:
+    """Pillow is optional, it is only needed to render covers"""
+    return importlib.util.find_spec('PIL') is not None
+
+
+def render_thumbnails(data: bytes) -> Dict[str, bytes]:
+    """Render the kobo thumbnails of a cover image, returns the JPEG data keyed by file name ending.
+
+    Runs in a worker process, Pillow is only imported there"""
+    from PIL import Image
+    thumbnails = {}
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert('RGB')
+        for ending, size in COVER_SIZES.items():
+            thumbnail = image.copy()
+            thumbnail.thumbnail(size, Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            thumbnail.save(output, 'JPEG', quality=COVER_QUALITY)
+            thumbnails[ending] = output.getvalue()
+    return thumbnails
+
+
+def write_thumbnails(image_dir: str, image_id: str, thumbnails: Dict[str, bytes]):
+    os.makedirs(image_dir, exist_ok=True)
+    for ending, data in thumbnails.items():
+        path = os.path.join(image_dir, image_id + ending)
+        with open(path + '.tmp', 'wb') as _f:
+            _f.write(data)
+        os.replace(path + '.tmp', path)
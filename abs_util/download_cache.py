@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from abs_util.api import ABSApi
+from abs_util.stats import STATS
+
+
+class DownloadCache:
+    """Shares ebook files between readers so every file is only requested from the server once.
+
+    Ebook files are kept in directory keyed by item id, ino and size, readers copy them from there. If max_size is set the least
+    recently used files are removed once the cache grows beyond it, files are only kept beyond it while a reader still copies them."""
+
+    def __init__(self, client: ABSApi, directory: str, max_size: Optional[int] = None):
+        self.client = client
+        self.directory = directory
+        self.max_size = max_size
+        self._files: Dict[str, asyncio.Task] = {}
+        # file name -> [size, last use]
+        self._index: Optional[Dict[str, List[float]]] = None
+        self._index_lock = asyncio.Lock()
+        # file name -> number of readers that still have to copy the file
+        self._users: Dict[str, int] = {}
+
+    @staticmethod
+    async def _once(tasks: Dict[Hashable, asyncio.Task], key: Hashable, factory: Callable[[], Awaitable]):
+        """Run factory only once per key, all callers get the same result. Failed attempts are started again by the next caller"""
+        task = tasks.get(key)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            task = tasks[key] = asyncio.ensure_future(factory())
+        # one caller giving up must not cancel the transfer for everyone else
+        return await asyncio.shield(task)
+
+    def _scan(self) -> Dict[str, List[float]]:
+        os.makedirs(self.directory, exist_ok=True)
+        index = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith('.part'):
+                    stat = entry.stat()
+                    index[entry.name] = [stat.st_size, stat.st_mtime]
+        return index
+
+    async def _get_index(self) -> Dict[str, List[float]]:
+        # concurrent first calls must share one index, otherwise files get recorded in an index that is replaced right after
+        async with self._index_lock:
+            if self._index is None:
+                self._index = await asyncio.to_thread(self._scan)
+        return self._index
+
+    async def _evict(self):
+        if self.max_size is None:
+            return
+        index = await self._get_index()
+        total = sum(size for size, _ in index.values())
+        for name, (size, _) in sorted(index.items(), key=lambda e: e[1][1]):
+            if total <= self.max_size:
+                break
+            if name in self._users:
+                continue
+            try:
+                await asyncio.to_thread(os.remove, os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            # another eviction may have removed it in the meantime
+            if index.pop(name, None) is not None:
+                total -= size
+
+    async def close(self):
+        """Enforce the size limit, files that were still in use may have kept the cache beyond it"""
+        await self._evict()
+
+    async def _fetch_file(self, name: str, item_id: str, ino: str, expected_size: Optional[int]) -> str:
+        path = os.path.join(self.directory, name)
+        index = await self._get_index()
+        cached = index.get(name)
+        now = time.time()
+        if cached is not None and (expected_size is None or cached[0] == expected_size):
+            try:
+                # the modification time marks the last use
+                await asyncio.to_thread(os.utime, path, (now, now))
+                cached[1] = now
+                STATS.record_cache(hit=True)
+                return path
+            except FileNotFoundError:
+                index.pop(name, None)
+        STATS.record_cache(hit=False)
+        await self.client.download_file(item_id, ino, path, expected_size)
+        index[name] = [await asyncio.to_thread(os.path.getsize, path), now]
+        await self._evict()
+        return path
+
+    @asynccontextmanager
+    async def use_file(self, item_id: str, ino: str, expected_size: Optional[int] = None) -> AsyncIterator[str]:
+        """Provide the path of the cached ebook file, downloading it if it is not cached yet.
+
+        The file is not evicted until the block is left, so it can be copied from there"""
+        name = f'{item_id}-{ino}-{expected_size}'
+        self._users[name] = self._users.get(name, 0) + 1
+        try:
+            yield await self._once(self._files, name, lambda: self._fetch_file(name, item_id, ino, expected_size))
+        finally:
+            self._users[name] -= 1
+            if self._users[name] == 0:
+                del self._users[name]
+                await self._evict()
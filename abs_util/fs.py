@@ -0,0 +1,87 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any, BinaryIO
+
+try:
+    import fcntl
+except ImportError:
+    # not available on windows
+    fcntl = None
+
+from abs_util.stats import STATS
+from abs_util.util import FS_WORKERS
+
+
+# ioctl that lets copy-on-write filesystems (btrfs, xfs) share the data of two files instead of copying it
+FICLONE = 0x40049409
+
+
+def reflink(source: BinaryIO, target: BinaryIO) -> bool:
+    """Try to clone source into target, returns False if the platform or filesystem does not support it"""
+    if fcntl is None or sys.platform != 'linux':
+        return False
+    try:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        return False
+
+
+class AsyncFS:
+    """Runs blocking filesystem operations in a dedicated thread pool so slow devices do not stall the event loop"""
+
+    def __init__(self, workers: int = FS_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='abs_util_fs')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def run(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def makedirs(self, path: str):
+        STATS.record_files()
+        await self.run(lambda: os.makedirs(path, exist_ok=True))
+
+    async def rmtree(self, path: str):
+        STATS.record_files()
+        await self.run(lambda: shutil.rmtree(path))
+
+    async def isdir(self, path: str) -> bool:
+        return await self.run(os.path.isdir, path)
+
+    async def isfile(self, path: str) -> bool:
+        return await self.run(os.path.isfile, path)
+
+    async def getmtime(self, path: str) -> float:
+        return await self.run(os.path.getmtime, path)
+
+    async def copy_file(self, source: str, target_path: str):
+        """Copy (or reflink where possible) source via a temporary .part file which is renamed to target_path once complete"""
+        def _copy():
+            part_path = target_path + '.part'
+            with open(source, 'rb') as _src, open(part_path, 'wb') as _dst:
+                if not reflink(_src, _dst):
+                    shutil.copyfileobj(_src, _dst, 1024 * 1024)
+                _dst.flush()
+                os.fsync(_dst.fileno())
+            os.replace(part_path, target_path)
+        STATS.record_files()
+        await self.run(_copy)
+
+    async def write_json(self, path: str, data):
+        def _write():
+            with open(path, 'w') as _f:
+                json.dump(data, _f)
+        STATS.record_files()
+        await self.run(_write)
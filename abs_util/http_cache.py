@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from aiohttp import ClientSession
+
+from abs_util.stats import STATS
+
+
+class RateLimiter:
+    """Spaces the start of requests at least 1 / rate seconds apart"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _load_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as _f:
+            return json.load(_f)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_text(path: str) -> str:
+    with open(path, encoding='utf-8') as _f:
+        return _f.read()
+
+
+def _store(directory: str, body_path: str, meta_path: str, body: str, meta: dict):
+    os.makedirs(directory, exist_ok=True)
+    with open(body_path + '.tmp', 'w', encoding='utf-8') as _f:
+        _f.write(body)
+    os.replace(body_path + '.tmp', body_path)
+    with open(meta_path + '.tmp', 'w') as _f:
+        json.dump(meta, _f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+class HTTPCache:
+    """Fetches pages through one shared session with a concurrency and rate limit.
+
+    Pages with an ETag or Last-Modified header are stored in directory and only transferred again if the server reports a change,
+    without a directory nothing is cached."""
+
+    def __init__(self, session: ClientSession, directory: Optional[str], rate: float, concurrency: int, retries: int = 3):
+        self.session = session
+        self.directory = directory
+        self.retries = retries
+        self.hits = 0
+        self.misses = 0
+        self._limiter = RateLimiter(rate)
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _paths(self, url: str) -> tuple:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.directory, f'{key}.json'), os.path.join(self.directory, f'{key}.html')
+
+    async def get(self, url: str) -> str:
+        meta_path, body_path = self._paths(url) if self.directory is not None else (None, None)
+        meta = await asyncio.to_thread(_load_json, meta_path) if meta_path is not None else None
+        headers = {}
+        if meta is not None:
+            if meta.get('etag') is not None:
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified') is not None:
+                headers['If-Modified-Since'] = meta['last_modified']
+        for attempt in range(self.retries + 1):
+            async with self._semaphore:
+                await self._limiter.wait()
+                start = time.perf_counter()
+                async with self.session.get(url, headers=headers) as response:
+                    if response.status == 304 and meta is not None:
+                        STATS.record_api('GET', urlsplit(url).path, time.perf_counter() - start)
+                        try:
+                            body = await asyncio.to_thread(_read_text, body_path)
+                        except OSError:
+                            # cached page is gone, fetch it again without the validators
+                            meta = None
+                            headers = {}
+                            continue
+                        self.hits += 1
+                        return body
+                    if (response.status == 429 or response.status >= 500) and attempt < self.retries:
+                        retry_after = response.headers.get('Retry-After', '')
+                        delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt
+                    else:
+                        response.raise_for_status()
+                        body = await response.text()
+                        STATS.record_api('GET', urlsplit(url).path, time.perf_counter() - start)
+                        self.misses += 1
+                        etag = response.headers.get('ETag')
+                        last_modified = response.headers.get('Last-Modified')
+                        if self.directory is not None and (etag is not None or last_modified is not None):
+                            await asyncio.to_thread(_store, self.directory, body_path, meta_path, body,
+                                                    {'url': url, 'etag': etag, 'last_modified': last_modified})
+                        return body
+            await asyncio.sleep(delay)
+        raise ConnectionError(f'Giving up on {url}')
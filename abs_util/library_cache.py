@@ -0,0 +1,108 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from colorama import Fore
+
+from abs_util.api import ABSApi
+from abs_util.util import LIBRARY_PAGE_SIZE, display_error
+
+
+class LibraryCache:
+    """In-memory copy of the item listing of one library, kept current with incremental fetches.
+
+    The expanded data of single items is requested on demand with expand and kept until the item changes, so readers synced from the
+    same cache share it. Only item_fields of the expanded items are kept."""
+
+    def __init__(self, client: ABSApi, target_lib: dict, page_size: int = LIBRARY_PAGE_SIZE, fields: Optional[Sequence[str]] = None,
+                 item_fields: Optional[Sequence[str]] = None):
+        self.client = client
+        self.target_lib = target_lib
+        self.page_size = page_size
+        self.fields = fields
+        self.item_fields = item_fields
+        self.items: Dict[str, dict] = {}
+        self.updated_at: Optional[int] = None
+        self.refreshed_at: Optional[float] = None
+        self._expanded: Dict[str, dict] = {}
+        self._lock = asyncio.Lock()
+        self._expand_lock = asyncio.Lock()
+
+    async def _load(self):
+        self.items = {d['id']: d async for d in self.client.iter_library_items(self.target_lib['id'], page_size=self.page_size,
+                                                                               fields=self.fields)}
+
+    async def refresh(self, full: bool = False) -> int:
+        """Bring the cache up to date and return the number of changed items.
+
+        Only items updated since the last refresh are fetched, the complete listing is loaded again on the first call, when the item
+        count shows that items were removed in the meantime or when the server does not sort the listing by update time."""
+        async with self._lock:
+            if full or self.updated_at is None:
+                await self._load()
+                changed = len(self.items)
+            else:
+                since = await self.client.get_library_items_since(self.target_lib['id'], self.updated_at,
+                                                                  page_size=self.page_size, fields=self.fields)
+                # without the update time order the changed items are unknown, with removed items the count does not add up
+                if since is not None and since[1] == len(self.items) + len([i for i in since[0] if i['id'] not in self.items]):
+                    self.items.update({d['id']: d for d in since[0]})
+                    changed = len(since[0])
+                else:
+                    await self._load()
+                    changed = len(self.items)
+            self.updated_at = max([i['updatedAt'] for i in self.items.values()] + [self.updated_at or 0])
+            self._expanded = {i: d for i, d in self._expanded.items() if i in self.items and self.items[i]['updatedAt'] == d['updatedAt']}
+            self.refreshed_at = time.monotonic()
+            return changed
+
+    def load(self, path: str) -> bool:
+        """Load the listing saved by a previous run, so the next refresh only needs the items that changed since then"""
+        try:
+            with open(path) as _f:
+                data = json.load(_f)
+        except (OSError, ValueError):
+            return False
+        if data.get('library') != self.target_lib['id'] or data.get('fields') != list(self.fields or []):
+            return False
+        self.items = data['items']
+        self.updated_at = data['updatedAt']
+        return True
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as _f:
+            json.dump({'library': self.target_lib['id'], 'fields': list(self.fields or []), 'updatedAt': self.updated_at,
+                       'items': self.items}, _f)
+        os.replace(path + '.tmp', path)
+
+    async def expand(self, item_ids: List[str]) -> Dict[str, dict]:
+        """Get the expanded data of the given items, keyed by item id. Only items that are not cached in their current version are
+        requested"""
+        async with self._expand_lock:
+            missing = [i for i in item_ids if i not in self._expanded
+                       or (i in self.items and self.items[i]['updatedAt'] != self._expanded[i]['updatedAt'])]
+            async for item in self.client.iter_library_items_batch(missing, fields=self.item_fields):
+                self._expanded[item['id']] = item
+        return {i: self._expanded[i] for i in item_ids if i in self._expanded}
+
+    async def snapshot(self) -> Tuple[Dict[str, dict], bool, int]:
+        """Return a copy of the cached items in the same form as a complete library listing"""
+        return dict(self.items), True, len(self.items)
+
+    async def keep_fresh(self, interval: float):
+        """Refresh the cache every interval seconds until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed = await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                display_error(f'Refreshing library {self.target_lib["name"]} failed: {e}')
+                continue
+            if changed > 0:
+                print(f'{Fore.LIGHTCYAN_EX}Refreshed library cache, {Fore.GREEN}{changed}{Fore.LIGHTCYAN_EX} '
+                      f'item{"s" if changed != 1 else ""} changed')
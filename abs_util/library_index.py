@@ -0,0 +1,98 @@
+import re
+import unicodedata
+from typing import Iterable, List, Optional, Tuple
+
+
+RE_PUNCTUATION = re.compile(r'[^\w\s]')
+RE_SPACES = re.compile(r'\s+')
+# "Title (Series Name, #1)" as used by Goodreads
+RE_SERIES_SUFFIX = re.compile(r'\s*\([^)]*#[\d.]+\)\s*$')
+RE_AUTHOR_SEPARATOR = re.compile(r',|&|;| and ')
+# "Series Name #1, Other Series #2.5" as in the seriesName of minified library items
+RE_SERIES_NAME = re.compile(r'(.+?)(?: #([^,#]+))?(?:, |$)')
+LEADING_ARTICLES = ('the ', 'a ', 'an ')
+
+
+def normalize(text: Optional[str]) -> str:
+    """Lowercase text without accents, punctuation, repeated whitespace or a leading article"""
+    if text is None:
+        return ''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = RE_SPACES.sub(' ', RE_PUNCTUATION.sub(' ', text.lower())).strip()
+    for article in LEADING_ARTICLES:
+        if text.startswith(article):
+            return text[len(article):]
+    return text
+
+
+def normalize_title(title: Optional[str]) -> str:
+    """Normalized title without series suffix and subtitle"""
+    if title is None:
+        return ''
+    return normalize(RE_SERIES_SUFFIX.sub('', title).split(':')[0])
+
+
+def normalize_sequence(sequence: Optional[str]) -> str:
+    """Series sequence with the number format unified, so 01, 1 and 1.0 are the same"""
+    if sequence is None:
+        return ''
+    try:
+        return f'{float(sequence):g}'
+    except ValueError:
+        return normalize(sequence)
+
+
+def split_authors(authors: Optional[str]) -> List[str]:
+    if authors is None:
+        return []
+    return [a for a in (normalize(author) for author in RE_AUTHOR_SEPARATOR.split(authors)) if len(a) > 0]
+
+
+def get_authors(metadata: dict) -> List[str]:
+    """Normalized authors of an item, minified items only have authorName while older servers only send the authors list"""
+    if metadata.get('authorName') is not None:
+        return split_authors(metadata['authorName'])
+    return [a for a in (normalize(author.get('name')) for author in metadata.get('authors') or []) if len(a) > 0]
+
+
+def get_series(metadata: dict) -> List[Tuple[str, Optional[str]]]:
+    """(name, sequence) of every series of an item, taken from the series list or parsed from seriesName of minified items"""
+    if metadata.get('series') is not None:
+        return [(series['name'], series.get('sequence')) for series in metadata['series']]
+    if not metadata.get('seriesName'):
+        return []
+    return [(match.group(1), match.group(2)) for match in RE_SERIES_NAME.finditer(metadata['seriesName']) if len(match.group(1)) > 0]
+
+
+class LibraryIndex:
+    """Normalized lookup of the books of a library by author and series position or by author and title"""
+
+    def __init__(self, items: Iterable[dict]):
+        self._series = {}
+        self._titles = {}
+        self.size = 0
+        for item in items:
+            self.add(item)
+
+    def add(self, item: dict):
+        metadata = item['media']['metadata']
+        title = normalize_title(metadata.get('title'))
+        series = get_series(metadata)
+        for author in get_authors(metadata):
+            if len(title) > 0:
+                self._titles[(author, title)] = item['relPath']
+            for name, sequence in series:
+                if sequence is not None:
+                    self._series[(author, normalize(name), normalize_sequence(sequence))] = item['relPath']
+        self.size += 1
+
+    def find(self, author: str, series: str, sequence: str, title: str) -> Optional[str]:
+        """Return the path of the matching library item or None if the book is not in the library"""
+        series_key = (normalize(series), normalize_sequence(sequence))
+        title_key = normalize_title(title)
+        for name in split_authors(author):
+            match = self._series.get((name,) + series_key) or self._titles.get((name, title_key))
+            if match is not None:
+                return match
+        return None
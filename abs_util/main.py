@@ -4,10 +4,8 @@ import colorama
 import os
 
 
-from abs_util.actions.setup import setup_parser
-from abs_util.actions.clear_authors import clear_authors_parser
-from abs_util.actions.kobo_sync import kobo_sync_parser
-from abs_util.actions.folder_from_goodreads import from_goodreads_parser
+from abs_util.commands import add_command_parsers
+from abs_util.stats import STATS
 from abs_util.util import get_config_file_path
 
 
@@ -29,13 +27,15 @@ def run():
     sub_parser = parser.add_subparsers(dest='action', title='actions', description='All actions supported by abs_util', metavar='action',
                                        required=True)
 
-    setup_parser(sub_parser, cfg)
-    clear_authors_parser(sub_parser, cfg)
-    from_goodreads_parser(sub_parser, cfg)
-    kobo_sync_parser(sub_parser, cfg)
+    add_command_parsers(sub_parser, cfg)
 
     args = parser.parse_args()
     try:
         args.func(args, cfg)
     except KeyboardInterrupt:
         pass
+    finally:
+        if args.stats:
+            STATS.print_report()
+        if args.stats_json is not None:
+            STATS.write_json(args.stats_json)
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+
+MANIFEST_FILE_NAME = 'abs-manifest.json'
+ITEM_FILE_NAME = 'abs-item.json'
+MANIFEST_VERSION = 1
+
+
+def new_manifest() -> dict:
+    return {'version': MANIFEST_VERSION, 'items': {}}
+
+
+def make_entry(item_id: str, folder: str, file: Optional[str] = None, ino: Optional[str] = None, size: Optional[int] = None,
+               mtime: Optional[float] = None, updated_at: Optional[int] = None, sha256: Optional[str] = None,
+               cover: Optional[dict] = None, metadata_synced: Optional[int] = None) -> dict:
+    """Build a manifest entry, folder is relative to the library directory on the device and file relative to folder.
+
+    metadata_synced is the updatedAt of the ABS item whose metadata was last written to the reader database"""
+    return {
+        'id': item_id,
+        'folder': folder,
+        'file': file,
+        'ino': ino,
+        'size': size,
+        'mtime': mtime,
+        'updatedAt': updated_at,
+        'sha256': sha256,
+        'cover': cover,
+        'metadataSynced': metadata_synced
+    }
+
+
+def file_sha256(path: str) -> str:
+    with open(path, 'rb') as _f:
+        return hashlib.file_digest(_f, 'sha256').hexdigest()
+
+
+def verify_entry(lib_dir: str, entry: dict, check_hash: bool = False) -> bool:
+    """Check that the ebook file of an entry exists and matches the recorded size (and hash if requested and known).
+
+    Entries from older versions without file information can not be checked and count as valid."""
+    if entry.get('file') is None or entry['size'] is None:
+        return True
+    path = os.path.join(lib_dir, entry['folder'], entry['file'])
+    try:
+        if os.path.getsize(path) != entry['size']:
+            return False
+    except OSError:
+        return False
+    if check_hash and entry.get('sha256') is not None:
+        return file_sha256(path) == entry['sha256']
+    return True
+
+
+def load_manifest(lib_dir: str) -> Optional[dict]:
+    """Load the sync manifest of a library directory, returns None if there is no usable manifest"""
+    try:
+        with open(os.path.join(lib_dir, MANIFEST_FILE_NAME), 'r') as _f:
+            manifest = json.load(_f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(lib_dir: str, manifest: dict):
+    """Atomically replace the sync manifest of a library directory"""
+    os.makedirs(lib_dir, exist_ok=True)
+    path = os.path.join(lib_dir, MANIFEST_FILE_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as _f:
+        json.dump(manifest, _f, separators=(',', ':'))
+        _f.flush()
+        os.fsync(_f.fileno())
+    os.replace(tmp_path, path)
+
+
+def rescan_manifest(lib_dir: str) -> dict:
+    """Rebuild the sync manifest from the abs-item.json files of a library directory"""
+    manifest = new_manifest()
+    items: Dict[str, dict] = manifest['items']
+    for root, dirs, files in os.walk(lib_dir):
+        if ITEM_FILE_NAME not in files:
+            continue
+        with open(os.path.join(root, ITEM_FILE_NAME), 'r') as _f:
+            item_data = json.load(_f)
+        folder = os.path.relpath(root, lib_dir).replace(os.sep, '/')
+        items[item_data['id']] = make_entry(item_data['id'], folder, item_data.get('file'), item_data.get('ino'), item_data.get('size'),
+                                            item_data.get('mtime'), item_data.get('updatedAt'), item_data.get('sha256'))
+    return manifest
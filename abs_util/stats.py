@@ -0,0 +1,117 @@
+import json
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+from colorama import Fore, Style
+
+
+# path segments following these are ids and get grouped together
+ID_PARENTS = ('items', 'libraries', 'authors', 'file', 'series', 'show')
+
+
+def get_endpoint(method: str, path: str) -> str:
+    """Turn a request into an endpoint name with ids replaced, e.g. GET /api/items/:id"""
+    parts = path.split('?')[0].split('/')
+    for i in range(1, len(parts)):
+        if parts[i - 1] in ID_PARENTS and len(parts[i]) > 0:
+            parts[i] = ':id'
+    return f'{method} {"/".join(parts)}'
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class Stats:
+    """Collects timing and I/O numbers of one run"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.api: Dict[str, List[float]] = {}
+        self.bytes_downloaded = 0
+        self.files_touched = 0
+        self.sqlite_statements = 0
+        self.sqlite_commits = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def record_api(self, method: str, path: str, seconds: float):
+        self.api.setdefault(get_endpoint(method, path), []).append(seconds)
+
+    def record_download(self, size: int):
+        self.bytes_downloaded += size
+
+    def record_files(self, count: int = 1):
+        self.files_touched += count
+
+    def record_cache(self, hit: bool):
+        if hit:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+    def record_sqlite(self, statement: str):
+        """trace callback for sqlite connections"""
+        self.sqlite_statements += 1
+        if statement.lstrip().upper().startswith('COMMIT'):
+            self.sqlite_commits += 1
+
+    def report(self) -> dict:
+        all_calls = [t for times in self.api.values() for t in times]
+        return {
+            'wall_s': time.perf_counter() - self.start,
+            'phases_s': self.phases,
+            'api': {
+                'calls': len(all_calls),
+                'endpoints': {name: {
+                    'calls': len(times),
+                    'total_s': sum(times),
+                    'p50_ms': percentile(times, 50) * 1000,
+                    'p90_ms': percentile(times, 90) * 1000,
+                    'p99_ms': percentile(times, 99) * 1000
+                } for name, times in sorted(self.api.items())}
+            },
+            'bytes_downloaded': self.bytes_downloaded,
+            'files_touched': self.files_touched,
+            'sqlite': {'statements': self.sqlite_statements, 'commits': self.sqlite_commits},
+            'ebook_cache': {'hits': self.cache_hits, 'misses': self.cache_misses}
+        }
+
+    def print_report(self):
+        report = self.report()
+        print(f'{Fore.LIGHTCYAN_EX}Run statistics ({Fore.GREEN}{report["wall_s"]:.2f}s{Fore.LIGHTCYAN_EX} total):')
+        for name, seconds in report['phases_s'].items():
+            print(f'{Fore.LIGHTCYAN_EX}- phase {Fore.GREEN}{name}{Fore.LIGHTCYAN_EX}: {Fore.GREEN}{seconds:.2f}s')
+        for name, endpoint in report['api']['endpoints'].items():
+            print(f'{Fore.LIGHTCYAN_EX}- {Fore.GREEN}{name}{Fore.LIGHTCYAN_EX}: {Fore.GREEN}{endpoint["calls"]}{Fore.LIGHTCYAN_EX} calls, '
+                  f'p50 {Fore.GREEN}{endpoint["p50_ms"]:.0f}ms{Fore.LIGHTCYAN_EX}, p90 {Fore.GREEN}{endpoint["p90_ms"]:.0f}ms'
+                  f'{Fore.LIGHTCYAN_EX}, p99 {Fore.GREEN}{endpoint["p99_ms"]:.0f}ms')
+        print(f'{Fore.LIGHTCYAN_EX}- downloaded {Fore.GREEN}{report["bytes_downloaded"]}{Fore.LIGHTCYAN_EX} bytes, touched '
+              f'{Fore.GREEN}{report["files_touched"]}{Fore.LIGHTCYAN_EX} files, {Fore.GREEN}{report["sqlite"]["statements"]}'
+              f'{Fore.LIGHTCYAN_EX} sqlite statements, {Fore.GREEN}{report["sqlite"]["commits"]}{Fore.LIGHTCYAN_EX} commits'
+              f'{Style.RESET_ALL}')
+        if self.cache_hits + self.cache_misses > 0:
+            print(f'{Fore.LIGHTCYAN_EX}- ebook cache: {Fore.GREEN}{self.cache_hits}{Fore.LIGHTCYAN_EX} hits, {Fore.GREEN}{self.cache_misses}'
+                  f'{Fore.LIGHTCYAN_EX} misses{Style.RESET_ALL}')
+
+    def write_json(self, path: str):
+        with open(path, 'w') as _f:
+            json.dump(self.report(), _f, indent=2)
+
+
+STATS = Stats()
+
+
+def reset_stats():
+    STATS.__init__()
@@ -3,10 +3,14 @@ import platform
 import subprocess
 from typing import List, Optional
 from colorama import Fore, Style
-from prompt_toolkit.shortcuts import prompt
-from prompt_toolkit.styles import Style as tk_Style
-from prompt_toolkit.output import ColorDepth
-from platformdirs import user_config_dir
+from platformdirs import user_config_dir, user_cache_dir
+
+
+LIBRARY_PAGE_SIZE = 500
+PROGRESS_BATCH_SIZE = 100
+ITEM_BATCH_SIZE = 100
+FS_WORKERS = 4
+EBOOK_CACHE_SIZE = 2048
 
 
 def get_config_file_path():
@@ -18,6 +22,40 @@ def get_config_file_path():
         'config.json')
 
 
+def get_token_cache_path():
+    return os.path.join(
+        user_config_dir(
+            appname='abs_util',
+            appauthor='teekeks',
+            ensure_exists=True),
+        'tokens.json')
+
+
+def get_ebook_cache_dir():
+    return os.path.join(
+        user_cache_dir(
+            appname='abs_util',
+            appauthor='teekeks'),
+        'ebooks')
+
+
+def get_http_cache_dir():
+    return os.path.join(
+        user_cache_dir(
+            appname='abs_util',
+            appauthor='teekeks'),
+        'http')
+
+
+def get_library_cache_path(library_id: str):
+    return os.path.join(
+        user_cache_dir(
+            appname='abs_util',
+            appauthor='teekeks'),
+        'libraries',
+        f'{library_id}.json')
+
+
 def check_setup(args, cfg) -> List[str]:
     caps = []
     if cfg.get('server') is not None:
@@ -32,7 +70,7 @@ def check_setup(args, cfg) -> List[str]:
     return caps
 
 
-def add_default_args(sub_parser, cfg, target, required_override: Optional[bool] = None):
+def add_default_args(sub_parser, cfg, target, required_override: Optional[bool] = None, multiple: bool = False):
     if target == 'base-api':
         sub_parser.add_argument('-s', '--server', help='Audiobookshelf Server URL', default=cfg.get('server'),
                                 required=False if required_override is None else required_override)
@@ -41,10 +79,13 @@ def add_default_args(sub_parser, cfg, target, required_override: Optional[bool]
         sub_parser.add_argument('-p', '--password', help='Audiobookshelf Password', default=cfg.get('password'),
                                 required=False if required_override is None else required_override)
     if target == 'library':
-        sub_parser.add_argument('-l', '--library', default=cfg.get('library'), help='The Audiobookshelf library to target',
+        sub_parser.add_argument('-l', '--library', default=cfg.get('library'), nargs='+' if multiple else None,
+                                help='The Audiobookshelf libraries to target' if multiple else 'The Audiobookshelf library to target',
                                 required=False if required_override is None else required_override)
     if target == 'kobo-dir':
-        sub_parser.add_argument('-kdir', '--kobo-dir', help='The Directory your Kobo Reader is mounted to',
+        sub_parser.add_argument('-kdir', '--kobo-dir', nargs='+' if multiple else None,
+                                help='The Directories your Kobo Readers are mounted to' if multiple else
+                                'The Directory your Kobo Reader is mounted to',
                                 required=True if required_override is None else required_override)
 
 
@@ -58,6 +99,10 @@ def open_path(path):
 
 
 def request_prompt(question: str, default: Optional[str] = None) -> str:
+    # prompt_toolkit is slow to import and only needed for interactive actions
+    from prompt_toolkit.shortcuts import prompt
+    from prompt_toolkit.styles import Style as tk_Style
+    from prompt_toolkit.output import ColorDepth
     style = tk_Style.from_dict({
         '': '#ff0066',
         'question': 'ansicyan',
@@ -0,0 +1,100 @@
+"""Synthetic Kobo reader mount for benchmarks.
+
+Creates the directory layout of a mounted reader with a KoboReader.sqlite that contains a content table like the one the
+firmware maintains, and can emulate the import the reader does after it is unplugged.
+"""
+import os
+import random
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict, Tuple
+
+
+CONTENT_SCHEMA = '''
+CREATE TABLE content (
+    ContentID TEXT NOT NULL,
+    ContentType TEXT NOT NULL,
+    MimeType TEXT NOT NULL,
+    BookID TEXT,
+    BookTitle TEXT,
+    ImageId TEXT,
+    Title TEXT COLLATE NOCASE,
+    Subtitle TEXT,
+    Attribution TEXT COLLATE NOCASE,
+    Description TEXT,
+    DateCreated TEXT,
+    DateLastRead TEXT,
+    ReadStatus INT,
+    ___PercentRead INTEGER,
+    ___FileSize INT,
+    ___NumPages INT DEFAULT -1,
+    ___UserID TEXT NOT NULL,
+    ___SyncTime TEXT,
+    Series TEXT,
+    SeriesNumber TEXT,
+    SeriesNumberFloat REAL,
+    SeriesID TEXT,
+    Accessibility INT DEFAULT 1,
+    PRIMARY KEY (ContentID)
+)
+'''
+
+
+def create_fake_kobo(path: str, unrelated_books: int = 200, seed: int = 1) -> str:
+    """Create an empty reader mount with some books that were not put there by abs_util"""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(path, '.kobo'), exist_ok=True)
+    db = sqlite3.connect(os.path.join(path, '.kobo', 'KoboReader.sqlite'))
+    db.execute(CONTENT_SCHEMA)
+    rows = []
+    for i in range(unrelated_books):
+        content_id = f'file:///mnt/onboard/Books/other-{i}.epub'
+        rows.append(_content_row(content_id, f'Other Book {i}', f'Other Author {i % 17}', 64 * 1024, rng))
+    db.executemany(INSERT_QUERY, rows)
+    db.commit()
+    db.close()
+    return path
+
+
+INSERT_QUERY = ('INSERT OR IGNORE INTO content (ContentID, ContentType, MimeType, BookTitle, ImageId, Title, Attribution, DateCreated, '
+                'DateLastRead, ReadStatus, ___PercentRead, ___FileSize, ___UserID) VALUES (?, 6, ?, NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+def _content_row(content_id: str, title: str, author: str, size: int, rng: random.Random) -> tuple:
+    now = datetime.now(timezone.utc)
+    read = rng.random() < 0.2
+    return (content_id, 'application/epub+zip', content_id.replace('/', '_').replace(':', '_').replace('.', '_').replace(' ', '_'),
+            title, author, now.isoformat(timespec='seconds'),
+            now.isoformat(timespec='seconds').replace('+00:00', 'Z') if read else None,
+            1 if read else 0, rng.randint(1, 99) if read else 0, size, 'bench-user')
+
+
+def simulate_import(path: str, seed: int = 1) -> int:
+    """Add content rows for all books below abs-library that the reader does not know yet, returns the number of new rows"""
+    rng = random.Random(seed)
+    rows = []
+    for root, dirs, files in os.walk(os.path.join(path, 'abs-library')):
+        for filename in files:
+            if not filename.endswith('.epub'):
+                continue
+            rel = os.path.relpath(os.path.join(root, filename), path).replace(os.sep, '/')
+            size = os.path.getsize(os.path.join(root, filename))
+            rows.append(_content_row(f'file:///mnt/onboard/{rel}', os.path.splitext(filename)[0], 'Unknown', size, rng))
+    db = sqlite3.connect(os.path.join(path, '.kobo', 'KoboReader.sqlite'))
+    before = db.total_changes
+    db.executemany(INSERT_QUERY, rows)
+    db.commit()
+    added = db.total_changes - before
+    db.close()
+    return added
+
+
+def read_book_metadata(path: str) -> Dict[str, Tuple[str, str, str]]:
+    """Title, author and series of every book below abs-library, keyed by ContentID"""
+    db = sqlite3.connect(os.path.join(path, '.kobo', 'KoboReader.sqlite'))
+    try:
+        rows = db.execute('SELECT ContentID, Title, Attribution, Series FROM content WHERE ContentType == 6 AND ContentID LIKE ?',
+                          ('file:///mnt/onboard/abs-library/%',)).fetchall()
+    finally:
+        db.close()
+    return {row[0]: row[1:] for row in rows}
@@ -0,0 +1,284 @@
+"""Local stand-in for the Audiobookshelf endpoints used by abs_util.
+
+The server generates a synthetic book library of configurable size, adds a configurable latency to every request and counts
+requests and response bytes so benchmark runs can be compared. It also serves a fake Goodreads series page.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from typing import Optional
+
+from aiohttp import web
+
+
+LIBRARY_ID = 'lib_books'
+
+
+def make_token(lifetime: int = 3600) -> str:
+    def _encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+    return f'{_encode({"alg": "none"})}.{_encode({"exp": int(time.time()) + lifetime})}.mock'
+
+
+class MockLibrary:
+    """In-memory library state shared by all handlers"""
+
+    def __init__(self, size: int, ebook_size: int = 64 * 1024, seed: int = 1):
+        self.rng = random.Random(seed)
+        self.ebook_size = ebook_size
+        self.items = {}
+        self.progress = {}
+        self.authors = {}
+        self.covers = {}
+        now = int(time.time() * 1000) - size * 1000
+        for i in range(size):
+            self.add_item(i, now + i)
+        for i in range(size // 10):
+            # orphaned authors for clear-authors
+            author_id = f'aut_orphan_{i:06d}'
+            self.authors[author_id] = {'id': author_id, 'name': f'Orphan Author {i}', 'numBooks': 0}
+
+    def add_item(self, i: int, timestamp: int):
+        item_id = f'li_{i:06d}'
+        author = f'Author {i // 20}'
+        series = f'Series {i // 5}'
+        self.authors.setdefault(f'aut_{i // 20:06d}', {'id': f'aut_{i // 20:06d}', 'name': author, 'numBooks': 0})['numBooks'] += 1
+        # stored in the expanded form, the listing and the plain item endpoint get reduced copies
+        self.items[item_id] = {
+            'id': item_id,
+            'libraryId': LIBRARY_ID,
+            'relPath': f'{author}/{series}/{i % 5 + 1:02d} - Book {i}',
+            'addedAt': timestamp,
+            'updatedAt': timestamp,
+            'mediaType': 'book',
+            'media': {
+                'libraryItemId': item_id,
+                'metadata': {
+                    'title': f'Book {i}',
+                    'subtitle': None,
+                    'authors': [{'id': f'aut_{i // 20:06d}', 'name': author}],
+                    'authorName': author,
+                    'description': f'Description of book {i}. ' * 10,
+                    'series': [{'id': f'ser_{i // 5:06d}', 'name': series, 'sequence': str(i % 5 + 1)}],
+                    'seriesName': f'{series} #{i % 5 + 1}'
+                },
+                'coverPath': f'/metadata/items/{item_id}/cover.jpg',
+                'ebookFile': {
+                    'ino': f'{i}001',
+                    'metadata': {'filename': f'book-{i}.epub', 'relPath': f'book-{i}.epub', 'size': self.ebook_size}
+                }
+            }
+        }
+        if self.rng.random() < 0.3:
+            self.progress[item_id] = {
+                'libraryItemId': item_id,
+                'episodeId': None,
+                'isFinished': self.rng.random() < 0.3,
+                'ebookProgress': round(self.rng.random(), 2),
+                'progress': 0,
+                'lastUpdate': timestamp
+            }
+
+    def change(self, fraction: float):
+        """Change metadata of a fraction of all items, every second changed item also gets a new ebook file"""
+        now = int(time.time() * 1000)
+        changed = self.rng.sample(sorted(self.items), max(1, int(len(self.items) * fraction)))
+        for n, item_id in enumerate(changed):
+            item = self.items[item_id]
+            item['updatedAt'] = now
+            item['media']['metadata']['title'] += ' (revised)'
+            if n % 2 == 0:
+                efile = item['media']['ebookFile']
+                efile['ino'] = efile['ino'] + 'r'
+                efile['metadata']['size'] = self.ebook_size + 1024
+        return changed
+
+    def minified(self, item_id: str) -> dict:
+        """Item as in the library listing: author and series only as display names and no ebook file"""
+        item = self.items[item_id]
+        media = item['media']
+        metadata = media['metadata']
+        return {**{k: v for k, v in item.items() if k != 'media'}, 'media': {
+            'libraryItemId': item_id,
+            'metadata': {k: metadata[k] for k in ('title', 'subtitle', 'authorName', 'seriesName', 'description')},
+            'coverPath': media['coverPath'],
+            'ebookFormat': 'epub',
+            'numTracks': 0,
+            'size': media['ebookFile']['metadata']['size']
+        }}
+
+    def plain(self, item_id: str) -> dict:
+        """Item as returned by the item endpoint without expanded, with the author and series lists but no display names"""
+        item = self.items[item_id]
+        metadata = {k: v for k, v in item['media']['metadata'].items() if k not in ('authorName', 'seriesName')}
+        return {**item, 'media': {**item['media'], 'metadata': metadata}}
+
+    def ebook_bytes(self, item_id: str) -> bytes:
+        size = self.items[item_id]['media']['ebookFile']['metadata']['size']
+        seed = item_id.encode()
+        return (seed * (size // len(seed) + 1))[:size]
+
+
+class MockServer:
+
+    def __init__(self, library: MockLibrary, latency: float = 0.0, port: int = 0):
+        self.library = library
+        self.latency = latency
+        self.port = port
+        # switched off to emulate servers that do not know updatedAt as sort key and send their default order
+        self.sort_updated_at = True
+        self.requests = 0
+        self.bytes_sent = 0
+        self._runner: Optional[web.AppRunner] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def reset_counters(self):
+        self.requests = 0
+        self.bytes_sent = 0
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        self.requests += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        response = await handler(request)
+        if response.body is not None:
+            self.bytes_sent += len(response.body)
+        return response
+
+    def _json(self, data) -> web.Response:
+        return web.Response(body=json.dumps(data).encode(), content_type='application/json')
+
+    async def login(self, request: web.Request):
+        return self._json({'user': {'id': 'usr_1', 'username': 'bench', 'accessToken': make_token(), 'refreshToken': make_token(86400)}})
+
+    async def libraries(self, request: web.Request):
+        return self._json({'libraries': [{'id': LIBRARY_ID, 'name': 'Books', 'mediaType': 'book'}]})
+
+    async def library_items(self, request: web.Request):
+        limit = int(request.query.get('limit', 0))
+        page = int(request.query.get('page', 0))
+        items = list(self.library.items.values())
+        if request.query.get('sort') == 'updatedAt' and self.sort_updated_at:
+            items.sort(key=lambda i: i['updatedAt'], reverse=request.query.get('desc') == '1')
+        results = items[page * limit:(page + 1) * limit] if limit > 0 else items
+        # current servers send minified items whatever minified is set to
+        return self._json({'results': [self.library.minified(i['id']) for i in results], 'total': len(items), 'limit': limit,
+                           'page': page, 'minified': True})
+
+    async def library_item(self, request: web.Request):
+        item_id = request.match_info['item_id']
+        if request.query.get('expanded') == '1':
+            return self._json(self.library.items[item_id])
+        return self._json(self.library.plain(item_id))
+
+    async def batch_items(self, request: web.Request):
+        data = await request.json()
+        return self._json({'libraryItems': [self.library.items[i] for i in data['libraryItemIds'] if i in self.library.items]})
+
+    async def me(self, request: web.Request):
+        return self._json({'id': 'usr_1', 'mediaProgress': list(self.library.progress.values())})
+
+    async def batch_progress(self, request: web.Request):
+        for update in await request.json():
+            progress = self.library.progress.setdefault(update['libraryItemId'], {'libraryItemId': update['libraryItemId'],
+                                                                                 'episodeId': None, 'progress': 0})
+            progress.update(update)
+            progress['lastUpdate'] = int(time.time() * 1000)
+        return web.Response(text='OK')
+
+    async def authors(self, request: web.Request):
+        return self._json({'authors': list(self.library.authors.values())})
+
+    async def delete_author(self, request: web.Request):
+        self.library.authors.pop(request.match_info['author_id'], None)
+        return web.Response(text='OK')
+
+    async def download(self, request: web.Request):
+        data = self.library.ebook_bytes(request.match_info['item_id'])
+        if request.http_range.start is not None:
+            start = request.http_range.start
+            if start >= len(data):
+                return web.Response(status=416)
+            return web.Response(status=206, body=data[start:], content_type='application/epub+zip')
+        return web.Response(body=data, content_type='application/epub+zip')
+
+    async def cover(self, request: web.Request):
+        item_id = request.match_info['item_id']
+        if item_id not in self.library.covers:
+            # a plain grey image, generated once per item so every cover has its own ETag
+            from PIL import Image
+            output = io.BytesIO()
+            shade = int(item_id.split('_')[-1]) % 200 + 30
+            Image.new('RGB', (1200, 1800), (shade, shade, shade)).save(output, 'JPEG')
+            self.library.covers[item_id] = output.getvalue()
+        data = self.library.covers[item_id]
+        etag = f'"{hashlib.sha1(data).hexdigest()}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=data, content_type='image/jpeg', headers={'ETag': etag})
+
+    async def goodreads_series(self, request: web.Request):
+        series_nr = int(request.match_info['series_nr'])
+        books = ''.join(f'<div class="listWithDividers__item"><h3>Book {n}</h3><span>Series {series_nr} Book {n}</span>'
+                        f'<span itemprop="author">Author {series_nr // 4}</span></div>' for n in range(1, 11))
+        html = (f'<html><body><div class="responsiveSeriesHeader__title">Series {series_nr} Series</div>{books}'
+                f'{"<p>filler</p>" * 500}</body></html>')
+        etag = f'"{hashlib.sha1(html.encode()).hexdigest()}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=html, content_type='text/html', headers={'ETag': etag})
+
+    def _build_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_post('/login', self.login)
+        app.router.add_post('/auth/refresh', self.login)
+        app.router.add_get('/api/libraries', self.libraries)
+        app.router.add_get('/api/libraries/{library_id}/items', self.library_items)
+        app.router.add_get('/api/libraries/{library_id}/authors', self.authors)
+        app.router.add_post('/api/items/batch/get', self.batch_items)
+        app.router.add_get('/api/items/{item_id}', self.library_item)
+        app.router.add_get('/api/items/{item_id}/cover', self.cover)
+        app.router.add_get('/api/items/{item_id}/file/{ino}/download', self.download)
+        app.router.add_get('/api/me', self.me)
+        app.router.add_patch('/api/me/progress/batch/update', self.batch_progress)
+        app.router.add_delete('/api/authors/{author_id}', self.delete_author)
+        app.router.add_get('/series/{series_nr}', self.goodreads_series)
+        return app
+
+    async def _start(self):
+        self._runner = web.AppRunner(self._build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    def start(self):
+        """Start the server on a background thread so actions can run their own event loop"""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def _run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -0,0 +1,61 @@
+"""Measure the CLI startup cost of every abs_util action.
+
+Runs `python -X importtime -m abs_util <action> --help` for each registered action and reports the wall time, the total
+import time and the slowest top level imports. With --max-ms the script exits with an error if any action needs longer
+than that to import, which makes it usable as a regression check.
+
+    python benchmarks/startup.py --max-ms 150
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from abs_util.commands import COMMANDS
+
+
+def measure(action: str) -> dict:
+    cmd = [sys.executable, '-X', 'importtime', '-m', 'abs_util'] + ([action] if action else []) + ['--help']
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True, env={**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'})
+    wall = time.perf_counter() - start
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line.split(':', 1)[1].split('|')
+        imports.append((int(self_us), int(cumulative_us), name.rstrip()))
+    # nested imports are indented further than the single space in front of top level ones
+    top_level = [i for i in imports if not i[2].startswith('  ')]
+    return {
+        'action': action or '(none)',
+        'returncode': proc.returncode,
+        'wall_ms': wall * 1000,
+        'import_ms': sum(i[0] for i in imports) / 1000,
+        'slowest': sorted(top_level, key=lambda i: i[1], reverse=True)[:5]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='abs_util startup benchmark')
+    parser.add_argument('--max-ms', type=float, default=None, help='Fail if the import time of any action exceeds this')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per action, the fastest one is reported')
+    args = parser.parse_args()
+    failed = False
+    for action in [''] + [c.name for c in COMMANDS]:
+        result = min((measure(action) for _ in range(args.runs)), key=lambda r: r['import_ms'])
+        print(f'{result["action"]:<28} wall {result["wall_ms"]:8.1f} ms   imports {result["import_ms"]:8.1f} ms')
+        for self_us, cumulative_us, name in result['slowest']:
+            print(f'    {cumulative_us / 1000:8.1f} ms  {name.strip()}')
+        if result['returncode'] != 0:
+            print(f'    exited with {result["returncode"]}')
+            failed = True
+        if args.max_ms is not None and result['import_ms'] > args.max_ms:
+            print(f'    exceeds the limit of {args.max_ms} ms')
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
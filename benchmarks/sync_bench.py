@@ -0,0 +1,150 @@
+"""End to end benchmark of the abs_util actions against a local mock server and a synthetic Kobo mount.
+
+Reports wall time, request count, response bytes and sqlite commits for these scenarios:
+
+- kobo-sync: first sync to an empty reader
+- kobo-sync: sync after the reader imported everything, which applies the ABS metadata
+- kobo-sync: no-op sync
+- kobo-sync: sync after 5% of the library changed
+- kobo-sync: sync after another 5% changed on a server that ignores the updatedAt sort
+- kobo-sync: first sync to a wiped reader, served from the ebook cache
+- kobo-sync: first sync to three empty readers at once
+- clear-authors
+- goodreads-folder-import
+- goodreads-folder-import of 50 series from a file, cold, with the page cache and checked against the library
+
+    python benchmarks/sync_bench.py --items 5000 --latency-ms 20
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import abs_util.api
+import abs_util.actions.folder_from_goodreads
+from abs_util.commands import add_command_parsers
+from abs_util.stats import STATS, reset_stats
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_server import LIBRARY_ID, MockLibrary, MockServer  # noqa: E402
+from fake_kobo import create_fake_kobo, simulate_import, read_book_metadata  # noqa: E402
+
+
+def parse_action(argv) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='abs_util')
+    add_command_parsers(parser.add_subparsers(dest='action', required=True), {})
+    return parser.parse_args(argv)
+
+
+def run_scenario(name: str, argv, server: MockServer, quiet: bool) -> dict:
+    args = parse_action(argv)
+    server.reset_counters()
+    reset_stats()
+    stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.perf_counter()
+    try:
+        args.func(args, {})
+    finally:
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return {
+        'scenario': name,
+        'wall_s': round(time.perf_counter() - start, 3),
+        'requests': server.requests,
+        'bytes': server.bytes_sent,
+        'sqlite_statements': STATS.sqlite_statements,
+        'sqlite_commits': STATS.sqlite_commits,
+        'phases_s': {k: round(v, 3) for k, v in STATS.phases.items()}
+    }
+
+
+def check_metadata(kobo_dir: str, library: MockLibrary) -> int:
+    """Number of imported books whose title, author or series on the reader differ from the library"""
+    books = read_book_metadata(kobo_dir)
+    wrong = 0
+    for item in library.items.values():
+        metadata = item['media']['metadata']
+        content_id = f'file:///mnt/onboard/abs-library/{LIBRARY_ID}/{item["relPath"]}/{item["media"]["ebookFile"]["metadata"]["relPath"]}'
+        if content_id in books and books[content_id] != (metadata['title'], metadata['authorName'], metadata['series'][0]['name']):
+            wrong += 1
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description='abs_util sync benchmark')
+    parser.add_argument('--items', type=int, default=1000, help='Library size (100 - 50000)')
+    parser.add_argument('--latency-ms', type=float, default=10, help='Latency added to every request')
+    parser.add_argument('--ebook-size', type=int, default=16 * 1024, help='Size of every generated ebook in bytes')
+    parser.add_argument('--json', default=None, help='Also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', default=False, help='Show the output of the actions')
+    parser.add_argument('extra', nargs='*', help='Extra arguments passed to every kobo-sync run')
+    args = parser.parse_args()
+
+    library = MockLibrary(args.items, ebook_size=args.ebook_size)
+    server = MockServer(library, latency=args.latency_ms / 1000)
+    server.start()
+    results = []
+    # (scenario, books with wrong metadata, imported books)
+    errors = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # keep the benchmark logins out of the real token cache
+        abs_util.api.get_token_cache_path = lambda: os.path.join(tmp, 'tokens.json')
+        abs_util.actions.folder_from_goodreads.get_http_cache_dir = lambda: os.path.join(tmp, 'http')
+        kobo_dir = create_fake_kobo(os.path.join(tmp, 'kobo'))
+        api_args = ['-s', server.url, '-u', 'bench', '-p', 'bench']
+        sync_args = api_args + ['--cache-dir', os.path.join(tmp, 'cache')] + args.extra
+        kobo_sync = ['kobo-sync', '-l', 'books', '-kdir', kobo_dir] + sync_args
+        quiet = not args.verbose
+        results.append(run_scenario('kobo-sync first sync', kobo_sync, server, quiet))
+        imported = simulate_import(kobo_dir)
+        results.append(run_scenario('kobo-sync after import', kobo_sync, server, quiet))
+        errors.append(('kobo-sync after import', check_metadata(kobo_dir, library), imported))
+        results.append(run_scenario('kobo-sync no-op', kobo_sync, server, quiet))
+        library.change(0.05)
+        results.append(run_scenario('kobo-sync 5% changed', kobo_sync, server, quiet))
+        errors.append(('kobo-sync 5% changed', check_metadata(kobo_dir, library), imported))
+        server.sort_updated_at = False
+        library.change(0.05)
+        results.append(run_scenario('kobo-sync unsorted server', kobo_sync, server, quiet))
+        errors.append(('kobo-sync unsorted server', check_metadata(kobo_dir, library), imported))
+        server.sort_updated_at = True
+        wiped = create_fake_kobo(os.path.join(tmp, 'kobo-wiped'))
+        results.append(run_scenario('kobo-sync wiped reader', ['kobo-sync', '-l', 'books', '-kdir', wiped] + sync_args, server, quiet))
+        readers = [create_fake_kobo(os.path.join(tmp, f'kobo-{n}')) for n in range(3)]
+        results.append(run_scenario('kobo-sync 3 readers', ['kobo-sync', '-l', 'books', '-kdir'] + readers + sync_args, server, quiet))
+        results.append(run_scenario('clear-authors', ['clear-authors'] + api_args, server, quiet))
+        results.append(run_scenario('goodreads-folder-import',
+                                    ['goodreads-folder-import', '-libdir', os.path.join(tmp, 'library'),
+                                     '--goodreads-series', f'{server.url}/series/1'], server, quiet))
+        series_file = os.path.join(tmp, 'series.txt')
+        with open(series_file, 'w') as _f:
+            _f.write('\n'.join(f'{server.url}/series/{n}' for n in range(50)))
+        batch_import = ['goodreads-folder-import', '-libdir', os.path.join(tmp, 'library'), '--series-file', series_file, '--rate', '0']
+        results.append(run_scenario('goodreads 50 series', batch_import, server, quiet))
+        results.append(run_scenario('goodreads 50 series cached', batch_import, server, quiet))
+        abs_util.actions.folder_from_goodreads.get_library_cache_path = lambda library_id: os.path.join(tmp, f'{library_id}.json')
+        dedupe_import = batch_import[:2] + [os.path.join(tmp, 'library-dedupe')] + batch_import[3:] + ['-l', 'books'] + api_args
+        results.append(run_scenario('goodreads 50 series dedupe', dedupe_import, server, quiet))
+    server.stop()
+
+    print(f'{"scenario":<26}{"wall s":>10}{"requests":>10}{"bytes":>14}{"statements":>12}{"commits":>9}')
+    for r in results:
+        print(f'{r["scenario"]:<26}{r["wall_s"]:>10.3f}{r["requests"]:>10}{r["bytes"]:>14}{r["sqlite_statements"]:>12}'
+              f'{r["sqlite_commits"]:>9}')
+    if args.json is not None:
+        with open(args.json, 'w') as _f:
+            json.dump({'items': args.items, 'latency_ms': args.latency_ms, 'results': results}, _f, indent=2)
+    failed = [e for e in errors if e[1] > 0]
+    for scenario, wrong, imported in failed:
+        print(f'{scenario}: {wrong} of {imported} imported books do not have the metadata of the library', file=sys.stderr)
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
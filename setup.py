@@ -31,7 +31,6 @@ setup(
     },
     install_requires=[
         'pick',
-        'audiobookshelf@git+https://github.com/Teekeks/audiobookshelfAPI.git',
         'colorama~=0.4.6',
         'prompt_toolkit',
         'aiosqlite',
@@ -39,5 +38,9 @@ setup(
         'aiohttp',
         'platformdirs'
     ],
+    extras_require={
+        'fast': ['lxml'],
+        'covers': ['pillow']
+    },
     package_data={'abs_util': ['py.typed']}
 )